@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''
+Measure how much precompiled headers save when compiling submissions and
+testlib checkers with the same commands as the judge.
+
+Usage: bench/compile_pch.py [-n REPEAT]
+'''
+import argparse
+import os
+from os import path
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+cwd = path.dirname(path.realpath(__file__))
+sys.path.append(path.join(cwd, '..'))
+
+from hoj_judge import cache
+from hoj_judge import pch
+from hoj_judge.judge import cmd_compile_tpl, cmd_compile_checker_tpl
+
+
+SUBMISSION_SRC = r'''#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+    int n;
+    cin >> n;
+    vector<long long> a(n);
+    for (auto &x : a) cin >> x;
+    sort(a.begin(), a.end());
+    map<long long, int> cnt;
+    for (auto x : a) cnt[x]++;
+    cout << accumulate(a.begin(), a.end(), 0LL) << ' ' << cnt.size() << endl;
+}
+'''
+
+CHECKER_SRC = r'''#include "testlib.h"
+using namespace test;
+
+int main(int argc, char *argv[]) {
+    registerTestlibCmd(argc, argv);
+    long long p = ouf.readLong(), j = ans.readLong();
+    if (p != j)
+        quitf(_wa, "expected %lld, found %lld", j, p);
+    quitf(_ok, "answer is %lld", j);
+}
+'''
+
+
+def timeCompile(cmd, repeat):
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subp = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        samples.append(time.perf_counter() - t)
+        if subp.returncode != 0:
+            sys.exit('Compile failed: {}\n{}'.format(cmd, subp.stderr.decode()))
+    return samples
+
+
+def bench(title, cmd_tpl, src, headers, include_paths, tmpdir, store, repeat):
+    path_src = path.join(tmpdir, 'bench.cpp')
+    with open(path_src, 'w') as f:
+        f.write(src)
+
+    cmd = shlex.split(cmd_tpl.format(
+        src=shlex.quote(path_src),
+        output=shlex.quote(path.join(tmpdir, 'bench'))))
+    # after the precompiled headers, as the judge passes them
+    extra = [arg for p in include_paths for arg in ('-isystem', p)]
+
+    t = time.perf_counter()
+    with pch.includeArgs(cmd_tpl, headers, include_paths, store) as pch_args:
+        t_build = time.perf_counter() - t
+        if not pch_args:
+            sys.exit('Failed to precompile {}'.format(headers))
+
+        plain = timeCompile(cmd + extra, repeat)
+        with_pch = timeCompile(cmd + pch_args + extra, repeat)
+
+    m_plain, m_pch = statistics.median(plain), statistics.median(with_pch)
+    print('{}:'.format(title))
+    print('  building the PCH : {:8.0f} ms (once)'.format(t_build * 1000))
+    print('  without PCH      : {:8.0f} ms (median of {})'.format(m_plain * 1000, repeat))
+    print('  with PCH         : {:8.0f} ms (median of {})'.format(m_pch * 1000, repeat))
+    print('  reduction        : {:8.1f} %'.format((1 - m_pch / m_plain) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compiling with precompiled headers.')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='compiles per case.')
+    args = parser.parse_args()
+
+    include_path = path.realpath(path.join(cwd, '..', 'include'))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = cache.DiskCache(path.join(tmpdir, 'pch'))
+        bench('Submission with <bits/stdc++.h>', cmd_compile_tpl, SUBMISSION_SRC,
+              pch.SUBMISSION_HEADERS, [], tmpdir, store, args.repeat)
+        bench('Checker with testlib.h', cmd_compile_checker_tpl, CHECKER_SRC,
+              pch.CHECKER_HEADERS, [include_path], tmpdir, store, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+'''
+Judge synthetic submissions end to end, and report the latency of each stage
+of judging and the throughput, to catch regressions in the pipes, the checkers
+and the orchestration.
+
+It runs on a plain Linux box, without root, nsjail or MySQL: bench/sandbox.py
+stands in for nsjail, the models are bound to an SQLite database, and the
+config, test data, slot and caches live in a temporary directory. Only g++ and
+the generated protos (scripts/gen-protos.sh) are needed. The times include the
+stand-in sandbox, so compare them only with runs on the same box.
+
+The first rounds warm up the caches and are left out of the report, unless
+caches are disabled with --no-cache, in which case every submission is
+compiled again. Options of the judge can be set with -s, e.g.
+-s judge.streaming_diff=true, or -s 'judge.sandbox="rlimit"' to run the
+programs with the rlimit sandbox of the judge instead of the stand-in.
+
+Usage: bench/judge_e2e.py [-n ROUNDS] [-w WARMUP] [-l LINES] [-c CASE]... [-s SECTION.KEY=VALUE]...
+'''
+import argparse
+import collections
+import contextlib
+import functools
+import logging
+import os
+from os import path
+import random
+import shlex
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+cwd = path.dirname(path.realpath(__file__))
+sys.path.append(path.join(cwd, '..'))
+
+import toml
+from peewee import SqliteDatabase
+
+from hoj_judge import utils
+
+
+SANDBOX_PATH = path.join(cwd, 'sandbox.py')
+TIME_LIMIT = 1000
+MEM_LIMIT = 64 * 1024
+
+SUM_SRC = r'''#include <cstdio>
+int main() {
+    int n;
+    long long a, b;
+    if (scanf("%d", &n) != 1) return 0;
+    while (n--) {
+        scanf("%lld %lld", &a, &b);
+        printf("%lld\n", a + b/*EXTRA*/);
+    }
+}
+'''
+
+CASES = collections.OrderedDict([
+    ('ac', ('sum', SUM_SRC.replace('/*EXTRA*/', ''), 'AC')),
+    # wrong on the very last line only, so that the whole output is compared
+    ('wa', ('sum', SUM_SRC.replace('/*EXTRA*/', ' + (n == 0)'), 'WA')),
+    ('tle', ('sum', r'''int main() { volatile unsigned x = 0; for (;;) x++; }''', 'TLE')),
+    ('mle', ('sum', r'''#include <cstdio>
+#include <vector>
+int main() { std::vector<char> v(256 << 20, 1); printf("%d\n", v[12345]); }''', 'MLE')),
+    ('ole', ('sum', r'''#include <cstdio>
+int main() { for (;;) fputs("0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcde\n", stdout); }''', 'OLE')),
+    # stops at the first failed write, which is EFBIG with direct_output
+    ('ole_nosig', ('sum', r'''#include <csignal>
+#include <cstdio>
+int main() {
+    signal(SIGXFSZ, SIG_IGN);
+    while (fputs("0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcde\n", stdout) != EOF);
+}''', 'OLE')),
+    # leaves a busy child behind holding its stdout, which must not outlive it
+    ('orphan', ('sum', SUM_SRC.replace('int main() {', '''#include <unistd.h>
+int main() {
+    if (fork() == 0) { for (;;); }''').replace('/*EXTRA*/', ''), 'AC')),
+    ('ce', ('sum', r'''int main() { return x; }''', 'CE')),
+    ('special', ('special', SUM_SRC.replace('/*EXTRA*/', ''), 'AC')),
+])
+
+CHECKER_SRC = r'''#include "testlib.h"
+using namespace test;
+
+int main(int argc, char *argv[]) {
+    registerTestlibCmd(argc, argv);
+    int n = inf.readInt();
+    for (int i = 0; i < n; i++) {
+        long long p = ouf.readLong(), j = ans.readLong();
+        if (p != j)
+            quitf(_wa, "line %d: expected %lld, found %lld", i + 1, j, p);
+    }
+    quitf(_ok, "%d sums", n);
+}
+'''
+
+def expectedVerdict(name, conf):
+    '''The verdict of case `name` with the [judge] options `conf`.'''
+    # the streaming diff kills the program at the first mismatch, long before
+    # it reaches the output limit; direct outputs are only checked afterwards
+    if name.startswith('ole') and conf.get('streaming_diff') and not conf.get('direct_output'):
+        return 'WA'
+    return CASES[name][2]
+
+
+PROBLEM_IDS = {'sum': 9001, 'special': 9002}
+# 1 sample, then 2 groups of 2 tests
+TABULAR = '1 2\n{tl} {ml}\n2 0 50\n{tl} {ml}\n{tl} {ml}\n2 0 50\n{tl} {ml}\n{tl} {ml}\n'.format(
+    tl=TIME_LIMIT, ml=MEM_LIMIT)
+
+
+class StageTimer(object):
+    '''Collects the durations of the calls to the functions it wraps, by
+    stage. Nested calls of the same stage count once.'''
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.enabled = False
+        self._local = threading.local()
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            depth = getattr(self._local, stage, 0)
+            setattr(self._local, stage, depth + 1)
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if depth == 0 and self.enabled:
+                    self.samples[stage].append(time.perf_counter() - t)
+                setattr(self._local, stage, depth)
+        return timed
+
+
+@contextlib.contextmanager
+def quietStdout():
+    '''Send what the judge and its children print to /dev/null.'''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def writeConfig(tmpdir, no_cache, overrides):
+    cache_root = path.join(tmpdir, 'cache')
+    conf = {
+        'database': {'database': 'unused'},
+        'helper': {'socket': ''},
+        'judge': {},
+        'cache': {
+            'path': cache_root,
+            'testdata_path': path.join(cache_root, 'testdata'),
+        },
+    }
+    if no_cache:
+        conf['cache'].update(compile_max_mb=0, checker_max_mb=0, pch_max_mb=0)
+    for item in overrides:
+        key, _, value = item.partition('=')
+        section, _, key = key.rpartition('.')
+        conf.setdefault(section or 'judge', {})[key] = toml.loads('v = ' + value)['v']
+
+    conf_path = path.join(tmpdir, 'config.toml')
+    with open(conf_path, 'w') as f:
+        toml.dump(conf, f)
+    return conf_path
+
+
+def writeTestdata(root, judge_desc, num_lines, rng):
+    os.makedirs(root, exist_ok=True)
+    for i, (infile, outfile) in enumerate(judge_desc.testdata_files):
+        n = 3 if i < len(judge_desc.samples) else num_lines
+        pairs = [(rng.randrange(-10**9, 10**9), rng.randrange(-10**9, 10**9)) for _ in range(n)]
+        with open(path.join(root, infile), 'w') as f:
+            f.write('{}\n'.format(n))
+            f.writelines('{} {}\n'.format(a, b) for a, b in pairs)
+        with open(path.join(root, outfile), 'w') as f:
+            f.writelines('{}\n'.format(a + b) for a, b in pairs)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(timer, case_times, wall):
+    print('{:<16} {:>6} {:>10} {:>10} {:>10}'.format('stage', 'count', 'median', 'p90', 'total'))
+    for stage, samples in timer.samples.items():
+        print('{:<16} {:>6} {:>7.1f} ms {:>7.1f} ms {:>8.2f} s'.format(
+            stage, len(samples), statistics.median(samples) * 1000,
+            percentile(samples, 0.9) * 1000, sum(samples)))
+    print()
+    print('{:<16} {:>6} {:>10} {:>10}'.format('case', 'count', 'median', 'p90'))
+    for name, samples in case_times.items():
+        print('{:<16} {:>6} {:>7.1f} ms {:>7.1f} ms'.format(
+            name, len(samples), statistics.median(samples) * 1000, percentile(samples, 0.9) * 1000))
+    print()
+    num_subs = sum(map(len, case_times.values()))
+    num_tests = len(timer.samples['test'])
+    print('throughput: {:.2f} submissions/s, {:.1f} tests/s over {:.1f} s'.format(
+        num_subs / wall, num_tests / wall, wall))
+
+
+def bench(args, tmpdir):
+    cases = args.case or list(CASES)
+    judge_conf = utils.loadConfig(writeConfig(tmpdir, args.no_cache, args.set))['judge']
+
+    # after the config is loaded, since they read it on import
+    import hoj_judge.cli as cli
+    import hoj_judge.models_hoj as m
+    from hoj_judge import checkers
+    from hoj_judge import helper
+    from hoj_judge import judge
+    from hoj_judge._hoj_helpers import hoj_problem_judge_desc
+    from hoj_judge.slots import JudgeSlot
+
+    # the judge runs from the root of the repo, for include/ and the like
+    os.chdir(path.join(cwd, '..'))
+    helper.cmd_sudo_tpl = '{} {}'.format(shlex.quote(sys.executable), shlex.quote(SANDBOX_PATH))
+    judge.TESTDATA_PATH = path.join(tmpdir, 'testdata')
+
+    timer = StageTimer()
+    judge.taskCompileCached = timer.wrap('compile', judge.taskCompileCached)
+    judge.taskCompileChecker = timer.wrap('compile_checker', judge.taskCompileChecker)
+    judge.judgeSingleSubtask = timer.wrap('test', judge.judgeSingleSubtask)
+    for cls in vars(checkers).values():
+        if isinstance(cls, type) and hasattr(cls, 'check'):
+            cls.check = timer.wrap('check', cls.check)
+    m.judge_submission = timer.wrap('fetch', m.judge_submission)
+    cli.updateSubmission = timer.wrap('update', cli.updateSubmission)
+
+    db = SqliteDatabase(path.join(tmpdir, 'hoj.sqlite3'))
+    m.init(db)
+    db.connect()
+    db.create_tables([m.Contest, m.User, m.Problem, m.Submission])
+    user = m.User.create(user_nick='bench', user_password='', user_username='bench')
+
+    rng = random.Random(0)
+    for name, id in PROBLEM_IDS.items():
+        problem = m.Problem.create(
+            problem=id, problem_testdata=TABULAR, problem_special=int(name == 'special'),
+            problem_check=CHECKER_SRC if name == 'special' else None)
+        writeTestdata(path.join(judge.TESTDATA_PATH, str(id)),
+                      hoj_problem_judge_desc(problem), args.lines, rng)
+
+    slot = JudgeSlot(1, root=path.join(tmpdir, 'slots'))
+    case_times = collections.defaultdict(list)
+    failures = []
+    wall = 0
+
+    for i in range(args.warmup + args.rounds):
+        timer.enabled = (i >= args.warmup)
+        t_round = time.perf_counter()
+        for name in cases:
+            problem, code, _ = CASES[name]
+            expected = expectedVerdict(name, judge_conf)
+            id = m.Submission.create(user=user, problem=PROBLEM_IDS[problem],
+                                     submission_code=code).submission
+
+            t = time.perf_counter()
+            submission = m.judge_submission(id)
+            with quietStdout():
+                ret = cli.judgeSubmissionModel(submission, slot)
+            if ret is not None:
+                cli.updateSubmission(submission, ret['update'])
+            dt = time.perf_counter() - t
+
+            verdict = ret['verdict'].name if ret is not None else None
+            if verdict != expected:
+                failures.append('round {} {}: expected {}, got {}'.format(i, name, expected, verdict))
+            if timer.enabled:
+                case_times[name].append(dt)
+        if timer.enabled:
+            wall += time.perf_counter() - t_round
+        print('round {} done in {:.1f} s{}'.format(
+            i, time.perf_counter() - t_round, ' (warm-up)' if not timer.enabled else ''),
+            file=sys.stderr)
+
+    db.close()
+    report(timer, case_times, wall)
+    for failure in failures:
+        print('FAILED', failure)
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark judging submissions end to end.')
+    parser.add_argument('-n', '--rounds', type=int, default=3, help='measured rounds over the cases.')
+    parser.add_argument('-w', '--warmup', type=int, default=1, help='rounds to warm up with.')
+    parser.add_argument('-l', '--lines', type=int, default=50000, help='lines of each test.')
+    parser.add_argument('-c', '--case', action='append', choices=list(CASES),
+                        help='cases to run, all by default.')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help='set a config option, in TOML; the section defaults to judge.')
+    parser.add_argument('--no-cache', action='store_true', help='disable the compile caches.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the logs of the judge.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    tmpdir = tempfile.mkdtemp(prefix='hoj-bench-')
+    try:
+        ok = bench(args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
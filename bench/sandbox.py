@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''
+A stand-in for nsjail, for benchmarking the judge on a box without root,
+nsjail or cgroups. It takes the arguments the judge passes to nsjail and runs
+the program directly, with:
+
+- the wall-clock limit of -t,
+- the CPU limit of --rlimit_cpu and the file size limit of --rlimit_fsize,
+- the memory limit of --cgroup_mem_max, enforced by watching the resident set
+  of the program and killing it once it is over, which is reported as a
+  failcnt like a cgroup would,
+- the program in a process group of its own, which is killed once the
+  program exits, as nsjail kills whatever is left in the jail,
+
+and writes the same __STAT__ lines as nsjail to --log_fd. There is no
+isolation at all; run only trusted programs with it.
+
+Usage: sandbox.py [nsjail options] -- PROGRAM [ARGS...]
+'''
+import argparse
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# how often the resident set is checked
+MEMORY_POLL_INTERVAL = 0.002
+# the address space is capped as well, so that runaway programs cannot take
+# the box down before they are noticed
+ADDRESS_SPACE_FACTOR = 4
+ADDRESS_SPACE_SLACK = 256 * 1024 * 1024
+
+
+def residentBytes(pid):
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+class MemoryWatch(threading.Thread):
+    '''Kill `proc` once its resident set is over `limit` bytes.'''
+    def __init__(self, proc, limit):
+        super().__init__(daemon=True)
+        self.proc = proc
+        self.limit = limit
+        self.peak = 0
+        self.exceeded = False
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(MEMORY_POLL_INTERVAL):
+            try:
+                rss = residentBytes(self.proc.pid)
+            except (OSError, IndexError, ValueError):
+                return
+            self.peak = max(self.peak, rss)
+            if rss > self.limit:
+                self.exceeded = True
+                self.proc.kill()
+                return
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Run a program like nsjail, without a jail.')
+    parser.add_argument('-C', dest='config', help='ignored.')
+    parser.add_argument('-D', dest='cwd', default='.')
+    parser.add_argument('-t', dest='time_limit', type=int, default=0, help='wall-clock limit in seconds.')
+    parser.add_argument('--cgroup_mem_max', type=int, default=0, help='memory limit in bytes.')
+    parser.add_argument('--rlimit_cpu', type=int, default=0, help='CPU limit in seconds.')
+    parser.add_argument('--rlimit_fsize', type=int, default=0, help='file size limit in MB.')
+    parser.add_argument('--log_fd', type=int, default=2)
+    parser.add_argument('--pass_fd', type=int, action='append', default=[])
+
+    argv = sys.argv[1:]
+    if '--' not in argv:
+        parser.error('the program to run must follow --')
+    pos = argv.index('--')
+    # cgroup options and the like are accepted and ignored
+    args, _ = parser.parse_known_args(argv[:pos])
+    args.cmd = argv[pos + 1:]
+    if not args.cmd:
+        parser.error('no program to run')
+    return args
+
+
+def main():
+    args = parseArgs()
+    log = os.fdopen(args.log_fd, 'w')
+
+    def preexec():
+        if args.rlimit_cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (args.rlimit_cpu, args.rlimit_cpu))
+        if args.rlimit_fsize:
+            fsize = args.rlimit_fsize * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_FSIZE, (fsize, fsize))
+        if args.cgroup_mem_max:
+            cap = args.cgroup_mem_max * ADDRESS_SPACE_FACTOR + ADDRESS_SPACE_SLACK
+            resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+    t = time.monotonic()
+    proc = subprocess.Popen(args.cmd, cwd=args.cwd, preexec_fn=preexec, pass_fds=args.pass_fd,
+                            start_new_session=True)
+
+    def killGroup(*_):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    # the judge terminates the sandbox to stop the program
+    signal.signal(signal.SIGTERM, killGroup)
+
+    watch = None
+    if args.cgroup_mem_max:
+        watch = MemoryWatch(proc, args.cgroup_mem_max)
+        watch.start()
+
+    timed_out = False
+    try:
+        returncode = proc.wait(timeout=args.time_limit or None)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        killGroup()
+        returncode = proc.wait()
+    elapsed = int((time.monotonic() - t) * 1000)
+    # the group outlives its leader as long as anything is left in it
+    killGroup()
+
+    exceeded = False
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    if watch is not None:
+        watch.stop()
+        exceeded = watch.exceeded
+        peak = max(peak, watch.peak)
+
+    stats = [
+        ('time', elapsed),
+        ('cgroup_memory_max_usage', peak),
+        ('cgroup_memory_failcnt', 1 if exceeded else 0),
+        ('exit_normally', 'false' if timed_out or exceeded or returncode < 0 else 'true'),
+        ('seccomp_violation', 'false'),
+    ]
+    for key, value in stats:
+        log.write('[S][{}] __STAT__:0 {} = {}\n'.format(os.getpid(), key, value))
+    log.flush()
+
+    # like nsjail, report deaths by signals as 128 + the signal
+    sys.exit(returncode if returncode >= 0 else 128 - returncode)
+
+
+if __name__ == '__main__':
+    main()
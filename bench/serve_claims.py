@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+'''
+Check that the serve mode keeps its claims on the submissions whose results
+wait for a batched write, when the connection holding them is lost.
+
+The models are bound to an SQLite database, and the MySQL named locks behind
+the claims are emulated by connection, counted as MySQL does. The judge is a
+stub accepting everything, and the connection is replaced while it judges, the
+way the reconnecting database of the judge does on its own. Every check that
+fails is printed as FAILED, and the exit status is then 1.
+
+Usage: bench/serve_claims.py
+'''
+import logging
+from os import path
+import shutil
+import sys
+import tempfile
+
+cwd = path.dirname(path.realpath(__file__))
+sys.path.append(path.join(cwd, '..'))
+
+import toml
+from peewee import SqliteDatabase
+
+from hoj_judge import utils
+
+
+class NamedLocks(object):
+    '''MySQL named locks: held by a connection until it releases them as many
+    times as it got them, or goes away.'''
+    def __init__(self):
+        self.connection = 0
+        # lock -> [connection, count]
+        self.locks = {}
+
+    def get(self, name, connection=None):
+        connection = self.connection if connection is None else connection
+        holder = self.locks.setdefault(name, [connection, 0])
+        if holder[0] != connection:
+            return False
+        holder[1] += 1
+        return True
+
+    def release(self, name):
+        holder = self.locks.get(name)
+        if holder is not None and holder[0] == self.connection:
+            holder[1] -= 1
+            if holder[1] == 0:
+                del self.locks[name]
+
+    def reconnect(self):
+        self.locks = {name: holder for name, holder in self.locks.items()
+                      if holder[0] != self.connection}
+        self.connection += 1
+
+    def held(self, connection=None):
+        connection = self.connection if connection is None else connection
+        return {name: count for name, (holder, count) in self.locks.items()
+                if holder == connection}
+
+
+def check(tmpdir, failures):
+    utils.loadConfig(writeConfig(tmpdir))
+
+    # after the config is loaded, since they read it on import
+    import hoj_judge.models_hoj as m
+    from hoj_judge._hoj_helpers import HojVerdict
+    from hoj_judge.serve import JudgeDaemon
+
+    db = SqliteDatabase(path.join(tmpdir, 'hoj.sqlite3'))
+    m.init(db)
+    db.connect()
+    db.create_tables([m.Contest, m.User, m.Problem, m.Submission])
+    user = m.User.create(user_nick='bench', user_password='', user_username='bench')
+    problem = m.Problem.create(problem_testdata='')
+
+    locks = NamedLocks()
+    judged = []
+    m.claim_submission = lambda id: locks.get(id)
+    m.release_submission = lambda id: locks.release(id)
+    OTHER_WORKER = -1
+
+    def reconnect():
+        # as ReconnectingPooledMySQLDatabase.execute_sql does
+        locks.reconnect()
+        db.reconnects = getattr(db, 'reconnects', 0) + 1
+
+    pending_submissions = m.pending_submissions
+    before_claim = []
+
+    def pendingSubmissions(*args, **kwargs):
+        if before_claim and before_claim[0] == len(judged):
+            before_claim.pop()
+            reconnect()
+        return pending_submissions(*args, **kwargs)
+    m.pending_submissions = pendingSubmissions
+
+    def scenario(name, num, events, others={}, drop_before=None):
+        '''Judge `num` new submissions in one batch; events[i] is called with
+        their ids while the i-th is judged, and the connection is replaced
+        before the claim of the `drop_before`-th. Those in `others` must be
+        left with the status another worker has given them, and the rest
+        written.'''
+        ids = [m.Submission.create(user=user, problem=problem).submission for _ in range(num)]
+        judged.clear()
+        if drop_before is not None:
+            before_claim.append(drop_before)
+
+        def judge(submission, slot):
+            judged.append(submission.submission)
+            events.get(len(judged) - 1, lambda ids: None)(ids)
+            return {'verdict': HojVerdict.AC,
+                    'update': {'submission_status': HojVerdict.AC.value, 'submission_score': 100}}
+
+        daemon = JudgeDaemon(judge, None, batch_size=num, batch_interval=3600, pidfile=None)
+        # until there is nothing left to judge, which flushes the rest
+        while daemon.runOnce():
+            pass
+
+        statuses = m.submission_statuses(ids)
+        expected = {id: others.get(i, HojVerdict.AC.value) for i, id in enumerate(ids)}
+        if statuses != expected:
+            failures.append('{}: expected statuses {}, got {}'.format(name, expected, statuses))
+        if locks.held():
+            failures.append('{}: claims left behind: {}'.format(name, locks.held()))
+        # out of the way of the next scenarios
+        m.Submission.update(submission_status=HojVerdict.SKIPPED.value).where(
+            m.Submission.submission_status == 0).execute()
+        locks.locks.clear()
+
+    scenario('no drop', 3, {})
+    scenario('drop while results wait', 3, {1: lambda ids: reconnect()})
+    scenario('drop while the last is judged', 3, {2: lambda ids: reconnect()})
+    scenario('drop before a claim', 3, {}, drop_before=1)
+
+    def dropAndClaim(ids):
+        reconnect()
+        locks.get(ids[0], OTHER_WORKER)
+    scenario('claimed by another worker meanwhile', 3, {1: dropAndClaim}, others={0: 0})
+
+    def dropAndJudge(ids):
+        reconnect()
+        m.Submission.update(submission_status=HojVerdict.WA.value).where(
+            m.Submission.submission == ids[0]).execute()
+    scenario('judged by another worker meanwhile', 3, {1: dropAndJudge},
+             others={0: HojVerdict.WA.value})
+
+    db.close()
+
+
+def writeConfig(tmpdir):
+    conf = {
+        'database': {'database': 'unused'},
+        'helper': {'socket': ''},
+        'judge': {},
+        'cache': {'path': path.join(tmpdir, 'cache')},
+    }
+    conf_path = path.join(tmpdir, 'config.toml')
+    with open(conf_path, 'w') as f:
+        toml.dump(conf, f)
+    return conf_path
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    tmpdir = tempfile.mkdtemp(prefix='hoj-claims-')
+    failures = []
+    try:
+        check(tmpdir, failures)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    for failure in failures:
+        print('FAILED', failure)
+    print('{} failed'.format(len(failures)) if failures else 'ok')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+Measure how long it takes to start a sandbox and see it exit, through the
+helper (hoj_judge/helper.py) and through a plain subprocess, as the judge
+does with sudo when there is no helper.
+
+A trivial program, /bin/true by default, stands in for nsjail, so that only
+the cost of starting it is measured. The helper is started in a child process
+on a temporary socket; as root, it drops to the sandbox user as usual, and
+sudo is measured as well if it is there.
+
+Usage: bench/spawn_latency.py [-n RUNS] [-w WARMUP] [--program PATH]
+'''
+import argparse
+import logging
+import os
+from os import path
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+cwd = path.dirname(path.realpath(__file__))
+sys.path.append(path.join(cwd, '..'))
+
+from hoj_judge import helper
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def startHelper(socket_path, program):
+    '''Fork a helper serving on `socket_path`, and wait until it listens.'''
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            helper.HelperServer(socket_path, nsjail_path=program).serve_forever()
+        except KeyboardInterrupt:
+            code = 0
+        finally:
+            os._exit(code)
+
+    deadline = time.monotonic() + 10
+    while not path.exists(socket_path):
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            raise RuntimeError('The helper did not start')
+        time.sleep(0.01)
+    return pid
+
+
+def measure(spawn, runs, warmup):
+    samples = []
+    for i in range(warmup + runs):
+        t = time.perf_counter()
+        returncode = spawn().wait()
+        dt = time.perf_counter() - t
+        if returncode != 0:
+            raise RuntimeError('The program exited with {}'.format(returncode))
+        if i >= warmup:
+            samples.append(dt)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark starting sandboxes.')
+    parser.add_argument('-n', '--runs', type=int, default=500, help='measured runs of each way.')
+    parser.add_argument('-w', '--warmup', type=int, default=20, help='runs to warm up with.')
+    parser.add_argument('--program', default='/bin/true', help='the program standing in for nsjail.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    program = path.realpath(args.program)
+    tmpdir = tempfile.mkdtemp(prefix='hoj-spawn-')
+    # readable by the sandbox user, which the helper runs as
+    os.chmod(tmpdir, 0o755)
+    socket_path = path.join(tmpdir, 'helper.sock')
+    helper_pid = startHelper(socket_path, program)
+
+    ways = [
+        ('subprocess', lambda: subprocess.Popen(
+            [program], cwd=tmpdir, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)),
+        ('helper', lambda: helper.HelperProcess(
+            socket_path, [], tmpdir, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)),
+    ]
+    if os.geteuid() == 0 and shutil.which('sudo'):
+        ways.insert(1, ('sudo', lambda: subprocess.Popen(
+            ['sudo', '-u', helper.SANDBOX_USER, '--', program], cwd=tmpdir,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)))
+
+    try:
+        print('{:<12} {:>6} {:>10} {:>10} {:>10}'.format('way', 'runs', 'median', 'p90', 'mean'))
+        for name, spawn in ways:
+            samples = measure(spawn, args.runs, args.warmup)
+            print('{:<12} {:>6} {:>7.2f} ms {:>7.2f} ms {:>7.2f} ms'.format(
+                name, len(samples), statistics.median(samples) * 1000,
+                percentile(samples, 0.9) * 1000, statistics.mean(samples) * 1000))
+    finally:
+        os.kill(helper_pid, signal.SIGINT)
+        os.waitpid(helper_pid, 0)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,11 @@ from os import path
 
 from colors import color
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase
 
+from . import cache
 from . import utils
+from .models_hoj import parse_tabular
 from .datatypes import TaskDef, TaskSpec
 
 '''
@@ -14,10 +17,43 @@ A bridge to operate on managing submissions in HOJ DB.
 
 logger = logging.getLogger('_hoj_helpers')
 
+# MySQL client errors after which a statement may be run again on a new
+# connection: server gone away, lost connection, commands out of sync...
+RECONNECT_ERRORS = (2006, 2013, 2014, 2045, 2055)
+
+class ReconnectingPooledMySQLDatabase(PooledMySQLDatabase):
+    '''Pooled connections are pinged when taken from the pool, and recycled
+    after `stale_timeout` seconds. A statement failing because the server has
+    gone away is run once more on a new connection, unless it is part of a
+    transaction. Named locks held by the lost connection are gone for good;
+    `reconnects` counts the connections replaced so, for those holding any.'''
+    reconnects = 0
+
+    def execute_sql(self, *args, **kwargs):
+        try:
+            return super().execute_sql(*args, **kwargs)
+        except OperationalError as err:
+            if self.in_transaction() or not err.args or err.args[0] not in RECONNECT_ERRORS:
+                raise
+            logger.warning('Lost connection to the database, reconnecting: %s', err)
+            # do not return the broken connection to the pool
+            self.manual_close()
+            self.connect()
+            self.reconnects += 1
+            return super().execute_sql(*args, **kwargs)
+
+def makeDatabase(conf):
+    conf = dict(conf)
+    if conf.pop('pool', False):
+        return ReconnectingPooledMySQLDatabase(**conf)
+    return MySQLDatabase(**conf)
+
 config = utils.loadConfig()
-hoj_database = MySQLDatabase(**config['database'])
+hoj_database = makeDatabase(config['database'])
 
 class HojTaskDef(TaskDef):
+    __slots__ = ('label', 'time_limit', 'mem_limit', 'fallthrough')
+
     def __init__(self,
                  label=None,
                  time_limit=-1,
@@ -46,16 +82,19 @@ class HojVerdict(Enum):
     OTHER = 9
     SERR = 10
     RF = 11
+    # not run because the group has already failed
+    SKIPPED = 12
 
     def toPriority(self):
-        # SYSERR > Restricted > OTHER > CE > RE > OLE > TLE > MLE > PE > WA > AC
+        # SYSERR > Restricted > OTHER > CE > RE > OLE > TLE > MLE > PE > WA > SKIPPED > AC
         # in reverse order (increasing priority)
-        order = [1, 6, 7, 5, 4, 8, 2, 3, 9, 11, 10, 0]
+        order = [1, 12, 6, 7, 5, 4, 8, 2, 3, 9, 11, 10, 0]
         return order.index(self.value)
 
 
 '''
-Convert HOJ tabular problem description to compatiable format.
+Convert HOJ tabular problem description to compatiable format. The result is
+immutable, so that it can be shared between judges of the problem.
 '''
 def hoj_to_judge_desc(tabular):
     arr = iter(tabular)
@@ -75,10 +114,12 @@ def hoj_to_judge_desc(tabular):
     # a flattened subtask list
     desc_subtasks = []
     desc_task_groups = []
+    desc_group_bounds = []
     for i in range(num_subtasks):
         # <# small> <is-ocen?> <score>
         subheader = next(arr)
         num_small, is_ocen, score = subheader
+        start = len(desc_subtasks)
 
         if is_ocen:
             # Note that isOcen consume an extra row if it is true
@@ -86,29 +127,52 @@ def hoj_to_judge_desc(tabular):
             label = '{}-ocen'.format(i + 1)
             desc_subtasks.append(HojTaskDef(label, tl, ml, fallthrough=True))
 
-        desc_task_groups.append([num_small + is_ocen, score])
+        desc_task_groups.append((num_small + is_ocen, score))
 
         for j in range(num_small):
             label = genLabel(num_small).format(i + 1, j + 1)
             tl, ml = next(arr)
             desc_subtasks.append(HojTaskDef(label, tl, ml))
 
+        desc_group_bounds.append((start, len(desc_subtasks), score))
+
     return TaskSpec(
-        samples=desc_samples,
-        subtasks=desc_subtasks,
-        task_groups=desc_task_groups
+        samples=tuple(desc_samples),
+        subtasks=tuple(desc_subtasks),
+        task_groups=tuple(desc_task_groups),
+        testdata_files=tuple(('{}.in'.format(task.label), '{}.out'.format(task.label))
+                             for task in desc_samples + desc_subtasks),
+        group_bounds=tuple(desc_group_bounds)
     )
 
+'''
+Get the judge description of a problem, which is cached by the problem id and
+the digest of its tabular text, so that it is parsed again only when the
+problem has changed.
+'''
+_judge_descs = {}
+def hoj_problem_judge_desc(problem):
+    text = problem.problem_testdata or ''
+    key = cache.digest(text)
+    entry = _judge_descs.get(problem.problem)
+    if entry is None or entry[0] != key:
+        logger.debug('Parsing the judge description of problem %d', problem.problem)
+        entry = _judge_descs[problem.problem] = (key, hoj_to_judge_desc(parse_tabular(text)))
+    return entry[1]
+
 '''
 Check whether all testdata paths are valid.
 
-func_tpl l, x:
-    l is the label of the lask
-    x is either `in` or `out` to produce the file name of either infile or
-    outfile.
+testdata_files:
+    the names of the infile and outfile of each task, as in
+    TaskSpec.testdata_files.
+root:
+    the directory that has them.
+func_exists p:
+    whether the file at path p is there, which defaults to looking it up on
+    the filesystem.
 '''
-def hoj_collect_testdata(arr_subtasks, func_tpl):
-    exts = ('in', 'out')
+def hoj_collect_testdata(testdata_files, root, func_exists=path.isfile):
     healthy = True
     testdata = []
 
@@ -116,11 +180,11 @@ def hoj_collect_testdata(arr_subtasks, func_tpl):
     if is_verbose:
         verbose_buf = []
 
-    for task in arr_subtasks:
-        testdata_paths = tuple(func_tpl(task.label, ext) for ext in exts)
+    for names in testdata_files:
+        testdata_paths = tuple(path.join(root, name) for name in names)
 
-        for ext, p in zip(exts, testdata_paths):
-            exists = path.isfile(p)
+        for p in testdata_paths:
+            exists = func_exists(p)
 
             if is_verbose:
                 if exists:
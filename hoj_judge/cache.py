@@ -0,0 +1,198 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from os import path
+import shutil
+import stat
+import subprocess
+import tempfile
+
+from .utils import loadConfig
+
+'''
+Content-addressed stores on local disk. Every entry is a directory named after
+the hash of whatever determines its content, so an entry never needs to be
+invalidated: changed inputs simply map to another key. The stores are bounded
+in size and evict the least recently used entries; they are safe to share
+between judge processes. An entry is not evicted while someone holds its lock,
+which users of an entry take shared for as long as they read from it.
+
+Whoever can write to a store can have the judge run programs of their own, so
+a store is only used if the judge owns its directory and nobody else may write
+to it.
+'''
+
+logger = logging.getLogger(__name__)
+
+# in the home of the user running the judge rather than somewhere shared
+CACHE_ROOT_PATH = path.join(os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache'),
+                            'hoj-judge')
+CACHE_MAX_SIZE = 512 * 1024 * 1024
+META_FILENAME = 'meta.json'
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # length-prefixed so that the boundaries of parts matter
+        h.update(b'%d:' % len(part))
+        h.update(part)
+    return h.hexdigest()
+
+
+def fileDigest(*paths):
+    parts = []
+    for p in paths:
+        with open(p, 'rb') as f:
+            parts.append(f.read())
+    return digest(*parts)
+
+
+_compiler_versions = {}
+def compilerVersion(compiler):
+    if compiler not in _compiler_versions:
+        subp = subprocess.run([compiler, '--version'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        _compiler_versions[compiler] = subp.stdout.decode(errors='replace')
+    return _compiler_versions[compiler]
+
+
+def checkRoot(root):
+    '''Raise PermissionError unless `root` is a directory, not a symlink, of
+    the user running the judge that nobody else may write to.'''
+    st = os.lstat(root)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o022:
+        raise PermissionError('{} must be a directory owned by uid {} and writable by '
+                              'nobody else'.format(root, os.geteuid()))
+
+
+class DiskCache(object):
+    def __init__(self, root, max_size=CACHE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        checkRoot(root)
+
+    def __repr__(self):
+        return '<DiskCache {} max={}B>'.format(self.root, self.max_size)
+
+    def entryPath(self, key):
+        return path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        '''Get the path to the entry of `key`, or None if it is not cached.
+        The entry is marked as recently used.'''
+        entry = self.entryPath(key)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def meta(self, entry):
+        with open(path.join(entry, META_FILENAME)) as f:
+            return json.load(f)
+
+    def lockPath(self, key):
+        return self.entryPath(key) + '.lock'
+
+    @contextlib.contextmanager
+    def lock(self, key, shared=False):
+        '''Serialize builders of the same key across processes, or, if
+        `shared`, keep the entry from being built or evicted meanwhile.'''
+        lock_path = self.lockPath(key)
+        os.makedirs(path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put(self, key, files, meta=None):
+        '''Store `files` ({name: source path}) and `meta` as the entry of `key`.
+        Names may contain subdirectories.'''
+        entry = self.entryPath(key)
+        os.makedirs(path.dirname(entry), exist_ok=True)
+
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            for name, src in files.items():
+                dest = path.join(tmp, name)
+                os.makedirs(path.dirname(dest), exist_ok=True)
+                shutil.copy2(src, dest)
+            with open(path.join(tmp, META_FILENAME), 'w') as f:
+                json.dump(meta or {}, f)
+            os.rename(tmp, entry)
+        except OSError:
+            # most likely stored by someone else in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not path.isdir(entry):
+                raise
+
+        self.evict()
+        return entry
+
+    def evict(self):
+        entries = []
+        total = 0
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir() or bucket.name.startswith('.'):
+                continue
+            for ent in os.scandir(bucket.path):
+                if not ent.is_dir():
+                    continue
+                size = sum(path.getsize(path.join(dirpath, f))
+                           for dirpath, _, filenames in os.walk(ent.path)
+                           for f in filenames)
+                entries.append((ent.stat().st_mtime, size, ent.path))
+                total += size
+
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            if self._remove(entry):
+                logger.debug('Evicted cache entry %s (%d bytes)', entry, size)
+                total -= size
+            else:
+                logger.debug('Cache entry %s is in use, not evicting it', entry)
+
+    def _remove(self, entry):
+        '''Remove `entry` unless it is locked. Its lock file stays, since
+        others may have it open to wait on it.'''
+        with open(entry + '.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                shutil.rmtree(entry, ignore_errors=True)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+
+_caches = {}
+def getCache(name, root=None):
+    '''Get the store `name` as configured in the [cache] section of config, or
+    None if it is disabled or its directory cannot be trusted. It is kept
+    under `<name>_path` if set, or else `root`, or else a directory of
+    `path`.'''
+    if name not in _caches:
+        conf = loadConfig().get('cache', {})
+        max_mb = conf.get('{}_max_mb'.format(name), CACHE_MAX_SIZE // 1024 // 1024)
+        _caches[name] = None
+        if max_mb > 0:
+            root = conf.get('{}_path'.format(name), root) or \
+                path.join(conf.get('path') or CACHE_ROOT_PATH, name)
+            try:
+                _caches[name] = DiskCache(root, max_mb * 1024 * 1024)
+            except OSError as err:
+                logger.error('Cannot use %s for the %s store, disabling it: %s', root, name, err)
+    return _caches[name]
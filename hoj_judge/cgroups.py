@@ -0,0 +1,280 @@
+import logging
+import os
+from os import path
+
+'''
+Resource usage of sandboxed runs read from the cgroup of their slot. nsjail
+runs every program in a child of that cgroup and removes the child when the
+program ends, but its usage stays accounted in the parent. The CPU time of a
+run is therefore the difference of the parent's counter around it, and the
+memory peak is that of the parent, reset before the run, above its usage at
+that time. v2 only lets the peak be reset as of Linux 6.12; on older kernels
+the peak is left to the sandbox, and CPU times are still taken.
+
+Both the v1 hierarchy set up by judge_init.sh, where the cpu and cpuacct
+controllers are expected to be mounted together as usual, and the unified v2
+hierarchy are supported.
+
+The 'rlimit' sandbox, which runs programs without nsjail, puts them into the
+cgroup of their slot itself to limit their memory (see MemoryLimit).
+'''
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT_PATH = '/sys/fs/cgroup'
+# v1 controllers holding the counters
+CPU_CONTROLLER = 'cpu'
+MEMORY_CONTROLLER = 'memory'
+
+
+def isUnified(root=CGROUP_ROOT_PATH):
+    return path.exists(path.join(root, 'cgroup.controllers'))
+
+
+def readInt(p):
+    with open(p) as f:
+        return int(f.read())
+
+
+def readKeyed(p):
+    '''Read a flat keyed file such as cpu.stat into a dict of ints.'''
+    with open(p) as f:
+        return {k: int(v) for k, v in (ln.split() for ln in f if ln.strip())}
+
+
+_warned = set()
+def warnOnce(msg, *args, **kwargs):
+    '''Log a warning about counters that are unavailable, which holds for
+    every run, once per process; it is logged for debugging only after that.'''
+    level = logging.DEBUG if msg in _warned else logging.WARNING
+    _warned.add(msg)
+    logger.log(level, msg, *args, **kwargs)
+
+
+class MemoryPeak(object):
+    '''Measure the memory peak of the runs in the memory cgroup at `group`,
+    above its usage before each run, through either hierarchy. There must be
+    one run at a time in the cgroup.'''
+    def __init__(self, group):
+        self.group = group
+        self.unified = path.exists(path.join(group, 'memory.current'))
+
+        self._start = None
+        self._peak_file = None
+
+    def __repr__(self):
+        return '<MemoryPeak {} unified={}>'.format(self.group, self.unified)
+
+    def start(self):
+        '''Reset the peak before a run. Returns False if that fails, in which
+        case stop() returns None.'''
+        self.close()
+        try:
+            if self.unified:
+                # the peak is reset only for reads through the same file
+                self._peak_file = open(path.join(self.group, 'memory.peak'), 'r+')
+                self._peak_file.write('reset')
+                self._peak_file.flush()
+                self._start = readInt(path.join(self.group, 'memory.current'))
+            else:
+                with open(path.join(self.group, 'memory.max_usage_in_bytes'), 'w') as f:
+                    f.write('0')
+                self._start = readInt(path.join(self.group, 'memory.usage_in_bytes'))
+        except (OSError, ValueError):
+            warnOnce('Cannot reset the memory peak of %s, which needs cgroup v1 or Linux 6.12 '
+                'with v2; taking memory peaks from the sandbox instead', self.group, exc_info=True)
+            self.close()
+            return False
+        return True
+
+    def stop(self):
+        '''Returns the memory peak in bytes of the run since start(), or None
+        if it is unavailable.'''
+        if self._start is None:
+            return None
+        try:
+            if self.unified:
+                self._peak_file.seek(0)
+                peak = int(self._peak_file.read())
+            else:
+                peak = readInt(path.join(self.group, 'memory.max_usage_in_bytes'))
+        except (OSError, ValueError):
+            logger.warning('Cannot read the memory peak of %s', self.group, exc_info=True)
+            return None
+        finally:
+            start = self._start
+            self.close()
+        return max(peak - start, 0)
+
+    def close(self):
+        self._start = None
+        if self._peak_file is not None:
+            self._peak_file.close()
+            self._peak_file = None
+
+
+class CgroupMeter(object):
+    '''Measure the CPU time and memory peak of the runs in cgroup `name`.
+    There must be one run at a time in the cgroup.'''
+    def __init__(self, name, root=CGROUP_ROOT_PATH):
+        self.name = name
+        self.unified = isUnified(root)
+        if self.unified:
+            self.cpu_path = self.mem_path = path.join(root, name)
+        else:
+            self.cpu_path = path.join(root, CPU_CONTROLLER, name)
+            self.mem_path = path.join(root, MEMORY_CONTROLLER, name)
+
+        self._cpu_start = None
+        self._peak = MemoryPeak(self.mem_path)
+
+    def __repr__(self):
+        return '<CgroupMeter {} unified={}>'.format(self.name, self.unified)
+
+    def nsjailArgs(self, cpu_ms_per_sec=1000):
+        '''Arguments for nsjail to run programs under this cgroup, in addition
+        to --cgroup_mem_parent. nsjail only uses the cpu controller if it is
+        given a quota, so one full CPU is granted.'''
+        if self.unified:
+            return ['--use_cgroupv2', '--cgroupv2_mount', self.cpu_path]
+        return ['--cgroup_cpu_parent', self.name,
+                '--cgroup_cpu_ms_per_sec', str(cpu_ms_per_sec)]
+
+    def cpuUsage(self):
+        '''Total CPU time (user and system) consumed in microseconds.'''
+        if self.unified:
+            return readKeyed(path.join(self.cpu_path, 'cpu.stat'))['usage_usec']
+        return readInt(path.join(self.cpu_path, 'cpuacct.usage')) // 1000
+
+    def start(self):
+        '''Take the counters before a run. Returns False if the CPU time
+        cannot be read, in which case stop() returns None.'''
+        self.close()
+        try:
+            self._cpu_start = self.cpuUsage()
+        except (OSError, KeyError, ValueError):
+            warnOnce('Cannot read the CPU time of cgroup %s; timing runs by the wall clock instead',
+                self.name, exc_info=True)
+            return False
+        self._peak.start()
+        return True
+
+    def stop(self):
+        '''Returns (CPU time in ms, memory peak in bytes) of the run since
+        start(), or None if they are unavailable. The peak alone is None if it
+        cannot be reset, see MemoryPeak.'''
+        if self._cpu_start is None:
+            return None
+        try:
+            cpu_used = self.cpuUsage() - self._cpu_start
+        except (OSError, KeyError, ValueError):
+            logger.warning('Cannot read the counters of cgroup %s', self.name, exc_info=True)
+            self.close()
+            return None
+        self._cpu_start = None
+        return cpu_used // 1000, self._peak.stop()
+
+    def close(self):
+        self._cpu_start = None
+        self._peak.close()
+
+
+def memoryPath(name, root=CGROUP_ROOT_PATH):
+    '''Where the memory controller of cgroup `name` is.'''
+    return path.join(root, name) if isUnified(root) else path.join(root, MEMORY_CONTROLLER, name)
+
+
+class MemoryLimit(object):
+    '''Confine programs run without nsjail to cgroup `name`, under a memory
+    limit set per run. The cgroup must be writable by the judge; programs move
+    themselves into it with join(), from preexec_fn. There must be one run at a
+    time in the cgroup.'''
+    def __init__(self, name, root=CGROUP_ROOT_PATH):
+        self.name = name
+        self.unified = isUnified(root)
+        self.mem_path = memoryPath(name, root)
+
+        self._fails_start = None
+        self._peak_file = None
+
+    def __repr__(self):
+        return '<MemoryLimit {} unified={}>'.format(self.name, self.unified)
+
+    def available(self):
+        limit = 'memory.max' if self.unified else 'memory.limit_in_bytes'
+        return all(os.access(path.join(self.mem_path, f), os.W_OK) for f in ('cgroup.procs', limit))
+
+    def start(self, limit):
+        '''Set the limit to `limit` bytes and take the counters before a run.
+        Returns False if that fails, in which case stop() returns None.'''
+        self.close()
+        try:
+            if self.unified:
+                with open(path.join(self.mem_path, 'memory.max'), 'w') as f:
+                    f.write(str(limit))
+                swap = path.join(self.mem_path, 'memory.swap.max')
+                if path.exists(swap):
+                    with open(swap, 'w') as f:
+                        f.write('0')
+                self._peak_file = open(path.join(self.mem_path, 'memory.peak'), 'r+')
+                self._peak_file.write('reset')
+                self._peak_file.flush()
+            else:
+                with open(path.join(self.mem_path, 'memory.limit_in_bytes'), 'w') as f:
+                    f.write(str(limit))
+                with open(path.join(self.mem_path, 'memory.max_usage_in_bytes'), 'w') as f:
+                    f.write('0')
+            self._fails_start = memoryFailCount(self.mem_path)
+        except (OSError, KeyError, ValueError):
+            warnOnce('Cannot set up cgroup %s', self.name, exc_info=True)
+            self.close()
+            return False
+        return True
+
+    def join(self):
+        '''Move the calling process into the cgroup.'''
+        with open(path.join(self.mem_path, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+
+    def stop(self):
+        '''Returns (memory peak in bytes, whether the limit was hit) of the run
+        since start(), or None if they are unavailable.'''
+        if self._fails_start is None:
+            return None
+        try:
+            if self.unified:
+                self._peak_file.seek(0)
+                peak = int(self._peak_file.read())
+            else:
+                peak = readInt(path.join(self.mem_path, 'memory.max_usage_in_bytes'))
+            fails = memoryFailCount(self.mem_path) - self._fails_start
+        except (OSError, KeyError, ValueError):
+            logger.warning('Cannot read the counters of cgroup %s', self.name, exc_info=True)
+            return None
+        finally:
+            self.close()
+        return peak, fails > 0
+
+    def close(self):
+        self._fails_start = None
+        if self._peak_file is not None:
+            self._peak_file.close()
+            self._peak_file = None
+
+
+def jailGroups(name, root=CGROUP_ROOT_PATH):
+    '''The memory cgroups nsjail has created under cgroup `name`.'''
+    parent = memoryPath(name, root)
+    try:
+        return [e.path for e in os.scandir(parent)
+                if e.is_dir() and e.name.startswith('NSJAIL.')]
+    except OSError:
+        return []
+
+
+def memoryFailCount(group):
+    '''How many times the memory limit of `group` has been hit.'''
+    events = path.join(group, 'memory.events')
+    if path.exists(events):
+        return readKeyed(events)['max']
+    return readInt(path.join(group, 'memory.failcnt'))
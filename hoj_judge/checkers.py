@@ -0,0 +1,177 @@
+import logging
+from os import path
+import runpy
+import subprocess
+import threading
+
+from google.protobuf.wrappers_pb2 import Int64Value
+
+from . import diff
+from . import protos
+from ._hoj_helpers import HojVerdict
+
+'''
+Checkers take the SubtaskContext of a finished test and answer with a
+SubtaskResponse. Trusted Python checkers are registered here and called inside
+the judge process, saving an interpreter start-up and a protobuf round trip
+per test; everything else runs as a subprocess speaking the same protocol over
+stdin/stdout.
+'''
+
+logger = logging.getLogger(__name__)
+
+UTILS_PATH = path.join(path.dirname(path.abspath(__file__)), '..', 'utils')
+# scripts under utils/ that are safe to run in-process
+TRUSTED_SCRIPTS = ('tolerant_diff', 'hoj_special_judge')
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def register(name, func=None):
+    '''Register `func(cxt, *args) -> SubtaskResponse` as the trusted checker
+    `name`. Can be used as a decorator.'''
+    if func is None:
+        return lambda f: register(name, f)
+    _registry[name] = func
+    return func
+
+
+def lookup(name):
+    '''Get the trusted checker `name`, loading it from utils/ if it is one of
+    the trusted scripts. Returns None if there is no such checker.'''
+    with _registry_lock:
+        if name not in _registry and name in TRUSTED_SCRIPTS:
+            script = runpy.run_path(path.join(UTILS_PATH, name + '.py'))
+            register(name, script['main'])
+    return _registry.get(name)
+
+
+def errorResponse():
+    resp = protos.subtask_response_pb2.SubtaskResponse()
+    resp.verdict = HojVerdict.SERR.value
+    return resp
+
+
+class InProcessChecker(object):
+    def __init__(self, name, func, args=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+
+    def __repr__(self):
+        return '<InProcessChecker {} args={}>'.format(self.name, self.args)
+
+    def check(self, cxt):
+        try:
+            return self.func(cxt, *self.args)
+        except Exception:
+            logger.exception('The checker %s raised an exception', self.name)
+            return errorResponse()
+
+
+class SubprocessChecker(object):
+    def __init__(self, args):
+        self.args = list(args)
+
+    def __repr__(self):
+        return '<SubprocessChecker {}>'.format(self.args)
+
+    def check(self, cxt):
+        subp_checker = subprocess.run(
+            self.args,
+            input=cxt.SerializeToString(),
+            stdout=subprocess.PIPE
+            # TODO: triage stderr
+        )
+
+        resp = protos.subtask_response_pb2.SubtaskResponse()
+        if subp_checker.returncode == 0:
+            # the method name is confusing; it is in fact a byte string
+            try:
+                resp.ParseFromString(subp_checker.stdout)
+            except:
+                logger.exception('Error occurred when attempting to parse the response from the checker')
+                resp.verdict = HojVerdict.SERR.value
+        else:
+            logger.error('The checker exits abnormally with return code %d', subp_checker.returncode)
+            resp.verdict = HojVerdict.SERR.value
+        return resp
+
+
+class StreamingDiffChecker(object):
+    '''The tolerant diff done while the program is running. The output is
+    written through `stream()`, which lets the program be terminated as soon
+    as it goes wrong; `check()` then reports what the stream has found.
+    Outputs that have not been streamed are checked by `fallback`.'''
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __repr__(self):
+        return '<StreamingDiffChecker fallback={!r}>'.format(self.fallback)
+
+    def stream(self, output_path, tee=None):
+        return diff.StreamingDiff(output_path, tee)
+
+    def check(self, cxt, stream=None):
+        if stream is None:
+            return self.fallback.check(cxt)
+
+        diff_at = stream.finish()
+        resp = protos.subtask_response_pb2.SubtaskResponse()
+        resp.meta['lineno'].Pack(Int64Value(value=diff_at + 1))
+        if diff_at >= 0:
+            resp.verdict = HojVerdict.WA.value
+        else:
+            resp.verdict = HojVerdict.AC.value
+        return resp
+
+
+class FingerprintChecker(object):
+    '''Accepts an output whose hashes, taken while it is written through
+    `stream()`, match those of the expected output as `lookup(path)` gives
+    them from the manifest of the test data, without opening the expected
+    output. Outputs the program has written to a file itself are hashed
+    afterwards. Anything else, including outputs that are equal only up to
+    whitespace at the ends of lines, is checked by `fallback`.'''
+    def __init__(self, fallback, lookup):
+        self.fallback = fallback
+        self.lookup = lookup
+
+    def __repr__(self):
+        return '<FingerprintChecker fallback={!r}>'.format(self.fallback)
+
+    def stream(self, output_path, tee=None):
+        expected = self.lookup(output_path)
+        if expected is None or 'fingerprint' not in expected:
+            return None
+        return diff.OutputHash(tee)
+
+    def check(self, cxt, stream=None):
+        expected = self.lookup(cxt.subtask.output_path)
+        if stream is not None:
+            raw, normalized = stream.finish()
+            matched = (raw == expected['sha256'] or normalized == expected['fingerprint'])
+        elif expected is not None and 'fingerprint' in expected:
+            with open(cxt.subtask.output_user_path, 'rb') as f:
+                matched = (diff.fingerprintFile(f) == expected['fingerprint'])
+        else:
+            matched = False
+
+        if matched:
+            logger.debug('Output matches the fingerprint of %s', cxt.subtask.output_path)
+            resp = protos.subtask_response_pb2.SubtaskResponse()
+            resp.verdict = HojVerdict.AC.value
+            return resp
+        return self.fallback.check(cxt)
+
+
+def resolve(name, *args, in_process=True):
+    '''Get the checker `name` with extra arguments `args`. Trusted checkers run
+    in-process unless `in_process` is False; others are taken as scripts under
+    utils/ to run in a subprocess.'''
+    if in_process:
+        func = lookup(name)
+        if func is not None:
+            return InProcessChecker(name, func, args)
+    return SubprocessChecker([path.join(UTILS_PATH, name + '.py')] + list(args))
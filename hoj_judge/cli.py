@@ -1,25 +1,32 @@
 import argparse
 import logging
 import logging.config
+from os import path
 import sys
 
 logging.Formatter.default_msec_format = '%s.%03d'
 logger = logging.getLogger(__name__)
 
 from ._hoj_helpers import *
+from hoj_judge import metrics
 from hoj_judge.utils import loadConfig
+from hoj_judge.slots import DEFAULT_SLOT, JudgeSlot, makeSlots
 import hoj_judge.models_hoj as m
 import hoj_judge.judge
 
 
-def judgeSubmissionModel(submission):
+def judgeSubmissionModel(submission, slot=DEFAULT_SLOT):
     problem = submission.problem
-    judge_desc = hoj_to_judge_desc(problem.problem_testdata)
-    the_result, the_score, log_msg = hoj_judge.judge.judgeSubmission(submission, judge_desc)
+    if problem is None:
+        logger.error('Problem %s of submission %d does not exist',
+            submission.problem_id, submission.submission)
+        return None
+    judge_desc = hoj_problem_judge_desc(problem)
+    the_result, the_score, log_msg = hoj_judge.judge.judgeSubmission(submission, judge_desc, slot)
 
     if the_score < 0:
         logger.warning('Fatal error occurred as the score (%d) < 0', the_score)
-        sys.exit(1)
+        return None
 
     print('Results:')
     all_tasks = judge_desc.samples + judge_desc.subtasks
@@ -55,10 +62,22 @@ def judgeSubmissionModel(submission):
         }
     }
 
-def judgeSubmissionById(id):
+def updateSubmission(submission, outp):
+    submission.__data__.update(**outp)
+    submission.save()
+
+def judgeSubmissionById(id, slot=DEFAULT_SLOT):
+    with metrics.context(slot=slot.index, submission=id):
+        try:
+            _judgeSubmissionById(id, slot)
+        finally:
+            # also the spans of a failed judge, which exits early
+            metrics.export()
+
+def _judgeSubmissionById(id, slot):
     try:
-        with m.connection_context():
-            submission = m.Submission.get(m.Submission.submission == id)
+        with m.connection_context(), metrics.span('fetch'):
+            submission = m.judge_submission(id)
             is_already_judged = (submission.submission_status != 0)
     except m.OperationalError as err:
         logger.exception('OperationalError:')
@@ -70,8 +89,11 @@ def judgeSubmissionById(id):
     if is_already_judged:
         logger.warning('Submission is already judged, the record is not updated unless --force is specified.')
 
+    metrics.tag(problem=submission.problem_id)
     logging.info('Start judging submission of ID %d...', id)
-    ret = judgeSubmissionModel(submission)
+    ret = judgeSubmissionModel(submission, slot)
+    if ret is None:
+        sys.exit(1)
     outp = ret['update']
 
     print('Submission verdict: {!r}'.format(ret['verdict']))
@@ -80,15 +102,66 @@ def judgeSubmissionById(id):
     print('     (max) memory : {}'.format(outp['submission_mem']))
 
     if not is_already_judged:
-        submission.__data__.update(**outp)
-        with m.connection_context():
-            submission.save()
+        with m.connection_context(), metrics.span('update'):
+            updateSubmission(submission, outp)
         logger.info('Updated submission in database.')
 
 def exec(args):
         submission_id = args.submission_id
         m.init(hoj_database)
-        return judgeSubmissionById(submission_id)
+        return judgeSubmissionById(submission_id, JudgeSlot(args.slot))
+
+def serve(args):
+    from hoj_judge.serve import JudgeDaemon, superviseDaemons
+
+    conf = dict(loadConfig().get('serve', {}))
+    num_slots = conf.pop('slots', 1)
+    cpus_per_slot = conf.pop('cpus_per_slot', 1)
+    if args.poll_interval is not None:
+        conf['poll_interval'] = args.poll_interval
+    if args.slots is not None:
+        num_slots = args.slots
+
+    m.init(hoj_database)
+    if num_slots <= 1:
+        daemon = JudgeDaemon(judgeSubmissionModel, updateSubmission, **conf)
+        return daemon.run()
+
+    pidfile = conf.pop('pidfile', None)
+    daemons = [
+        JudgeDaemon(judgeSubmissionModel, updateSubmission, slot=slot, pidfile=None, **conf)
+        for slot in makeSlots(num_slots, cpus_per_slot)
+    ]
+    return superviseDaemons(daemons, pidfile=pidfile)
+
+def helper(args):
+    from hoj_judge.helper import DEFAULT_SOCKET_PATH, SANDBOX_USER, HelperServer
+
+    conf = loadConfig().get('helper', {})
+    server = HelperServer(
+        args.socket or conf.get('socket') or DEFAULT_SOCKET_PATH,
+        user=conf.get('user', SANDBOX_USER),
+        group=conf.get('group') or None,
+        nsjail_path=conf.get('nsjail') or None)
+    return server.serve_forever()
+
+def testdataIndex(args):
+    import hoj_judge.testdata
+
+    root = args.root or hoj_judge.testdata.TESTDATA_PATH
+    problem_ids = args.problem_ids or hoj_judge.testdata.problemIds(root)
+    failed = False
+    for problem_id in problem_ids:
+        man = hoj_judge.testdata.manifest(problem_id, root, force=args.force)
+        if not man.files:
+            logger.error('No test data for problem %s in %s', problem_id, man.path)
+            failed = True
+            continue
+        if not path.isfile(path.join(man.path, hoj_judge.testdata.MANIFEST_FILENAME)) and not man.save():
+            failed = True
+        print('{}: {} file(s), {} byte(s)'.format(
+            problem_id, len(man.files), sum(f['size'] for f in man.files.values())))
+    return 1 if failed else 0
 
 def main(as_module=False):
     config = loadConfig()
@@ -108,8 +181,49 @@ def main(as_module=False):
         help='Run judge of the specified submission ID.',
         description='Run judge of specified submission ID.')
     parser_exec.add_argument('submission_id', type=int, help='submission ID.')
+    parser_exec.add_argument('--slot', type=int, default=0,
+        help='index of the judge slot to use (default: 0).')
     parser_exec.set_defaults(func=exec)
 
+    parser_serve = subparsers.add_parser('serve',
+        help='Keep judging pending submissions.',
+        description='Stay resident and judge pending submissions as they arrive. '
+                    'Send SIGUSR1 (e.g. with emitter) to wake the judge up immediately.')
+    parser_serve.add_argument('--poll-interval', type=float, default=None,
+        help='seconds to wait between polls if nothing is pending.')
+    parser_serve.add_argument('--slots', type=int, default=None,
+        help='number of submissions to judge in parallel.')
+    parser_serve.set_defaults(func=serve)
+
+    parser_helper = subparsers.add_parser('helper',
+        help='Start sandboxes on behalf of the judge (run as root).',
+        description='Stay resident as root and start sandboxes for judges that connect to '
+                    'the socket, so that they do not need sudo. See [helper] in config.')
+    parser_helper.add_argument('--socket', default=None,
+        help='path of the socket to listen on (default: socket in [helper] of config).')
+    parser_helper.set_defaults(func=helper)
+
+    parser_testdata = subparsers.add_parser('testdata',
+        help='Manage test data.',
+        description='Manage test data.')
+    parser_testdata.set_defaults(func=lambda _: (parser_testdata.print_help(), parser_testdata.exit(1)))
+    testdata_subparsers = parser_testdata.add_subparsers(
+        dest='testdata_action',
+        metavar='<action>',
+        help='The action to take')
+
+    parser_testdata_index = testdata_subparsers.add_parser('index',
+        help='Build or update the manifests of test data.',
+        description='Build or update the manifest of every problem, or of the given ones, '
+                    'hashing the files that have changed since.')
+    parser_testdata_index.add_argument('problem_ids', nargs='*', metavar='problem_id',
+        help='problems to index (default: all).')
+    parser_testdata_index.add_argument('--root', default=None,
+        help='directory of test data (default: testdata/ of the repository).')
+    parser_testdata_index.add_argument('--force', action='store_true',
+        help='hash all files again.')
+    parser_testdata_index.set_defaults(func=testdataIndex)
+
     args = parser.parse_args()
     return args.func(args)
 
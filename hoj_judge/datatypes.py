@@ -1,8 +1,11 @@
 from collections import namedtuple
 
 class TaskDef(object):
-    pass
+    __slots__ = ()
 
+# testdata_files has the names of the input and output files of each of
+# samples + subtasks, and group_bounds has (start, end, score) for each group,
+# where start and end are indices into subtasks
 TaskSpec = namedtuple('TaskSpec', [
-    'samples', 'subtasks', 'task_groups'
+    'samples', 'subtasks', 'task_groups', 'testdata_files', 'group_bounds'
 ])
@@ -0,0 +1,315 @@
+import hashlib
+from itertools import repeat
+import mmap
+import os
+
+'''
+Tolerant comparison of outputs. Two outputs are equal if they have the same
+number of lines and each pair of lines is equal after stripping leading and
+trailing whitespace. Lines are terminated by "\n", "\r\n" or "\r", as with
+universal newlines in text mode.
+
+Outputs are compared as bytes: identical prefixes are skipped chunk by chunk
+and only the rest is split into lines, which are compared block by block.
+'''
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+# what str.strip() strips within ASCII; bytes.strip() misses \x1c-\x1f
+WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+
+def linesEqual(la, lb):
+    if la.strip(WHITESPACE) == lb.strip(WHITESPACE):
+        return True
+    if la.isascii() and lb.isascii():
+        return False
+    # non-ASCII whitespace such as U+00A0 is stripped as well
+    return (la.decode(errors='surrogateescape').strip()
+            == lb.decode(errors='surrogateescape').strip())
+
+
+def iterBlocks(m, pos=0):
+    '''Iterate over the lines of `m` from offset `pos`, which should be the
+    start of a line, in lists of about BLOCK_SIZE bytes. Line terminators are
+    dropped.'''
+    n = len(m)
+    while pos < n:
+        end = pos + BLOCK_SIZE
+        if end >= n:
+            end = n
+        else:
+            # cut the block after a line terminator, keeping "\r\n" together
+            cut = m.rfind(b'\n', pos, end)
+            if cut < 0:
+                cut = m.rfind(b'\r', pos, end - 1)
+            if cut < 0:
+                # a line longer than a block
+                cut = m.find(b'\n', end)
+                end = n if cut < 0 else cut + 1
+            else:
+                end = cut + 1
+        yield m[pos:end].splitlines()
+        pos = end
+
+
+def countLines(m, end):
+    '''Count line terminators in m[:end]. `end` must not split a "\r\n".'''
+    count = 0
+    pos = 0
+    while pos < end:
+        stop = min(pos + CHUNK_SIZE, end)
+        chunk = m[pos:stop]
+        count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+        if stop < end and chunk.endswith(b'\r') and m[stop] == ord('\n'):
+            count -= 1
+        pos = stop
+    return count
+
+
+def commonPrefix(ma, mb):
+    n = min(len(ma), len(mb))
+    pos = 0
+    while pos < n:
+        end = min(pos + CHUNK_SIZE, n)
+        if ma[pos:end] != mb[pos:end]:
+            # ma[pos:lo] == mb[pos:lo], and they differ within [lo, hi)
+            lo, hi = pos, end
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if ma[lo:mid] == mb[lo:mid]:
+                    lo = mid
+                else:
+                    hi = mid
+            return lo
+        pos = end
+    return n
+
+
+def lineStart(m, k):
+    '''Start of the line containing offset `k`, where m[:k] is known to be
+    shared by both outputs.'''
+    if k == 0:
+        return 0
+    # a "\r" right before k might be the first half of a "\r\n"
+    end = k - 1 if m[k - 1] == ord('\r') else k
+    return max(m.rfind(b'\n', 0, end), m.rfind(b'\r', 0, end)) + 1
+
+
+def firstDiff(lines_a, lines_b):
+    '''Index of the first pair of lines that differ in two lists of the same
+    length, or -1 if there is none.'''
+    if (lines_a == lines_b or
+            # e.g. trailing spaces on every line; map() keeps it in C
+            list(map(bytes.strip, lines_a, repeat(WHITESPACE)))
+            == list(map(bytes.strip, lines_b, repeat(WHITESPACE)))):
+        return -1
+    for i, (la, lb) in enumerate(zip(lines_a, lines_b)):
+        if la != lb and not linesEqual(la, lb):
+            return i
+    return -1
+
+
+def diffLines(blocks_a, blocks_b, line=0):
+    '''Compare two iterables of lists of lines. Returns the number of the
+    first line that differs, counting from `line`, or -1 if they are equal.'''
+    buf_a, buf_b = [], []
+    while True:
+        if not buf_a:
+            buf_a = next(blocks_a, [])
+        if not buf_b:
+            buf_b = next(blocks_b, [])
+        n = min(len(buf_a), len(buf_b))
+        if n == 0:
+            # either side runs out of lines
+            return -1 if not buf_a and not buf_b else line
+
+        k = firstDiff(buf_a[:n], buf_b[:n])
+        if k >= 0:
+            return line + k
+        buf_a, buf_b = buf_a[n:], buf_b[n:]
+        line += n
+
+
+def normalizeLines(lines):
+    '''Lines as linesEqual compares them, so that two lists of lines are
+    equal line by line if and only if they are equal after this.'''
+    if all(map(bytes.isascii, lines)):
+        return list(map(bytes.strip, lines, repeat(WHITESPACE)))
+    return [la.strip(WHITESPACE) if la.isascii() else
+            la.decode(errors='surrogateescape').strip().encode(errors='surrogateescape')
+            for la in lines]
+
+
+def updateFingerprint(h, lines):
+    if lines:
+        h.update(b'\n'.join(normalizeLines(lines)))
+        h.update(b'\n')
+
+
+def fingerprintFile(f):
+    '''Fingerprint of an output opened in binary mode: the SHA-256 of its
+    lines as normalizeLines makes them, each ended by "\n". Two outputs have
+    the same fingerprint if and only if tolerantDiffAt finds them equal,
+    barring collisions.'''
+    h = hashlib.sha256()
+    m = mapFile(f)
+    try:
+        for lines in iterBlocks(m):
+            updateFingerprint(h, lines)
+    finally:
+        if isinstance(m, mmap.mmap):
+            m.close()
+    return h.hexdigest()
+
+
+def mapFile(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def tolerantDiffAt(fa, fb):
+    '''Compare two outputs opened in binary mode. Returns the 0-based number
+    of the first line that differs, or -1 if they are equal.'''
+    ma, mb = mapFile(fa), mapFile(fb)
+    try:
+        k = commonPrefix(ma, mb)
+        if k == len(ma) == len(mb):
+            return -1
+        start = lineStart(ma, k)
+        return diffLines(iterBlocks(ma, start), iterBlocks(mb, start), countLines(ma, start))
+    finally:
+        for m in (ma, mb):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+
+class StreamingDiff(object):
+    '''Compare an output against the expected one while it is being written.
+    Once the output is known to differ, `aborted` becomes True and further
+    writes are discarded, so that whoever feeds it can stop the writer early.
+    Everything written before that is copied to `tee` if given.'''
+    def __init__(self, expected_path, tee=None):
+        self.tee = tee
+        self.line = 0
+        self.diff_at = None
+        self._file = open(expected_path, 'rb')
+        self._map = mapFile(self._file)
+        self._blocks = iterBlocks(self._map)
+        self._expected = []
+        self._pending = bytearray()
+        self._aborted = False
+        self._finished = False
+
+    def __repr__(self):
+        return '<StreamingDiff line={} diff_at={}>'.format(self.line, self.diff_at)
+
+    @property
+    def aborted(self):
+        # only a difference found while writing, not missing lines at the end
+        return self._aborted
+
+    def write(self, buf):
+        if self.aborted:
+            return
+        if self.tee is not None:
+            self.tee.write(buf)
+
+        start = max(len(self._pending) - 1, 0)
+        self._pending += buf
+        # complete lines only; a trailing "\r" may be the first half of "\r\n"
+        end = max(self._pending.rfind(b'\n', start),
+                  self._pending.rfind(b'\r', start, len(self._pending) - 1)) + 1
+        if end > 0:
+            lines = bytes(self._pending[:end]).splitlines()
+            del self._pending[:end]
+            self._compare(lines)
+            self._aborted = self.diff_at is not None
+
+    def _compare(self, lines):
+        while lines:
+            if not self._expected:
+                self._expected = next(self._blocks, [])
+                if not self._expected:
+                    # more lines than expected
+                    self.diff_at = self.line
+                    return
+            n = min(len(lines), len(self._expected))
+            k = firstDiff(lines[:n], self._expected[:n])
+            if k >= 0:
+                self.diff_at = self.line + k
+                return
+            lines, self._expected = lines[n:], self._expected[n:]
+            self.line += n
+
+    def finish(self):
+        '''Call when the output ends. Returns the 0-based number of the first
+        line that differs, or -1 if the outputs are equal.'''
+        if not self._finished:
+            self._finished = True
+            if self._pending and self.diff_at is None:
+                self._compare(bytes(self._pending).splitlines())
+                self._pending.clear()
+            if self.diff_at is None and (self._expected or next(self._blocks, [])):
+                # fewer lines than expected
+                self.diff_at = self.line
+        return -1 if self.diff_at is None else self.diff_at
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class OutputHash(object):
+    '''Hash an output while it is being written, copying it to `tee`. Besides
+    the SHA-256 of the output, it takes that of the output with "\r\n" and
+    "\r" turned into "\n" and a last line ended, which is its fingerprint
+    (see fingerprintFile) unless it has whitespace at the ends of lines.'''
+    # it never asks the writer to stop
+    aborted = False
+
+    def __init__(self, tee=None):
+        self.tee = tee
+        self._raw = hashlib.sha256()
+        self._lf = hashlib.sha256()
+        self._cr = False
+        self._last = b'\n'
+        self._digests = None
+
+    def __repr__(self):
+        return '<OutputHash>'
+
+    def write(self, buf):
+        if self.tee is not None:
+            self.tee.write(buf)
+        if not buf:
+            return
+        self._raw.update(buf)
+
+        buf = bytes(buf)
+        if self._cr:
+            buf = b'\r' + buf
+        # a trailing "\r" may be the first half of "\r\n"
+        self._cr = buf.endswith(b'\r')
+        if self._cr:
+            buf = buf[:-1]
+        if b'\r' in buf:
+            buf = buf.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        if buf:
+            self._lf.update(buf)
+            self._last = buf[-1:]
+
+    def finish(self):
+        '''Call when the output ends. Returns the SHA-256 of the output and
+        that with its line terminators normalized, in hex.'''
+        if self._digests is None:
+            if self._cr or self._last != b'\n':
+                self._lf.update(b'\n')
+            self._digests = (self._raw.hexdigest(), self._lf.hexdigest())
+        return self._digests
+
+    def close(self):
+        pass
@@ -0,0 +1,213 @@
+import logging
+import os
+from os import path
+import re
+import shlex
+import socket
+import subprocess
+
+from . import cgroups
+from . import helper
+from . import pipes
+
+'''
+Run the tests of a submission in one jail. runner/runner.c is started in
+nsjail once and forks the program for every test, which saves starting nsjail,
+setting up the namespaces and the cgroup and compiling the seccomp policy per
+test. The runner reports the same stats as nsjail does, so that the results
+are parsed in the same way.
+'''
+
+logger = logging.getLogger(__name__)
+
+# arguments to nsjail as sandbox.cmd_task_tpl; paths are relative to this
+# directory, except for the runner, which is started in the sandbox
+cmd_server_tpl = ('-C ../nsjail.forkserver.cfg -D {cwd} '
+    '-t 0 --cgroup_mem_parent {cgroup} --cgroup_mem_max {mem} {cgroup_args} '
+    '--pass_fd {sock_fd} --log_fd {log_fd} '
+    '-- {runner} {sock_fd} {exec}')
+
+RUNNER_PATH = path.realpath(path.join(path.dirname(__file__), '..', 'runner', 'runner'))
+
+SERVER_LOG_FILENAME = 'forkserver.log'
+# how long to wait for the jail to go away after closing it, and for the
+# output of a run to end after its wall-clock limit
+CLOSE_TIMEOUT = 5
+
+
+class ForkServer(object):
+    '''A jail running `exec_path` in the sandbox of `slot` on request. It is
+    (re)started whenever the options it was started with do not fit a run.'''
+    def __init__(self, slot, exec_path):
+        self.slot = slot
+        self.exec_path = exec_path
+        self.log_path = path.join(slot.work_path, SERVER_LOG_FILENAME)
+
+        self._proc = None
+        self._sock = None
+        self._reply = None
+        self._options = None
+        self._jail_group = None
+
+    def __repr__(self):
+        return '<ForkServer {} pid={}>'.format(
+            self.slot.sandbox_path, self._proc.pid if self._proc else None)
+
+    def start(self, mem, cgroup_args=()):
+        self.close()
+
+        sock, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        log_file = open(self.log_path, 'a')
+        os.chmod(self.log_path, 0o666)
+        try:
+            fds = (peer.fileno(), log_file.fileno())
+            cmd = shlex.split(cmd_server_tpl.format(
+                cwd=shlex.quote(path.realpath(self.slot.sandbox_path)),
+                cgroup=shlex.quote(self.slot.cgroup),
+                mem=mem,
+                cgroup_args=' '.join(map(shlex.quote, cgroup_args)),
+                sock_fd=fds[0],
+                log_fd=fds[1],
+                runner=shlex.quote(RUNNER_PATH),
+                exec=self.exec_path
+            ))
+
+            logger.debug('Starting fork server: %r', cmd)
+            self._proc = helper.spawn(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=log_file,
+                pass_fds=fds,
+                cpus=self.slot.task_cpus
+            )
+        except:
+            sock.close()
+            raise
+        finally:
+            peer.close()
+            log_file.close()
+
+        self._sock = sock
+        self._reply = sock.makefile('rb')
+        self._options = (mem, tuple(cgroup_args))
+        self._jail_group = None
+
+    def close(self):
+        if self._sock is not None:
+            # the runner exits as the socket is closed
+            self._reply.close()
+            self._sock.close()
+            self._sock = self._reply = None
+        if self._proc is not None:
+            try:
+                self._proc.wait(timeout=CLOSE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logger.warning('Fork server %r does not exit, killing it', self)
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+
+    def _jailGroup(self):
+        if self._jail_group is None:
+            groups = cgroups.jailGroups(self.slot.cgroup)
+            if len(groups) == 1:
+                self._jail_group = groups[0]
+        return self._jail_group
+
+    def _failCount(self):
+        group = self._jailGroup()
+        if group is None:
+            return None
+        try:
+            return cgroups.memoryFailCount(group)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _readStats(self, log_file):
+        '''Copy the stats of a run to `log_file`. Returns the return code.'''
+        # an empty line ends the stats
+        returncode = -1
+        try:
+            for ln in iter(self._reply.readline, b''):
+                if ln == b'\n':
+                    break
+                ln = ln.decode()
+                log_file.write(ln)
+                mat = re.search(r'__STAT__:0 exit_status = (\d+)', ln)
+                if mat is not None:
+                    returncode = int(mat.group(1))
+            else:
+                raise ConnectionError('unexpected EOF')
+        except OSError:
+            logger.exception('The fork server has gone away, see %s', self.log_path)
+            self.close()
+        return returncode
+
+    def run(self, f_in, dest, limit, log_file, mem, wall_secs, cpu_secs=0, cgroup_args=(),
+            direct=False):
+        '''Run the program once, reading `f_in` and with its output copied to
+        `dest` up to `limit` bytes as pipes.run_with_pipes does. With `direct`,
+        the program writes to the file `dest` itself, and `limit` is left to
+        the jail. The stats are written to `log_file`. Returns (return code,
+        is_stdout_ole).'''
+        if self._options != (mem, tuple(cgroup_args)) or self._proc.poll() is not None:
+            self.start(mem, cgroup_args)
+
+        fails_before = self._failCount()
+        group = self._jailGroup()
+        peak = cgroups.MemoryPeak(group) if group is not None else None
+        if peak is not None and not peak.start():
+            peak = None
+        if direct:
+            fd_out, fd_out_w = None, dest.fileno()
+        else:
+            fd_out, fd_out_w = os.pipe()
+        # the runner kills the program once this is written to or closed
+        fd_kill_r, fd_kill = os.pipe()
+        try:
+            socket.send_fds(self._sock, [b'%d %d\n' % (wall_secs, cpu_secs)],
+                            [f_in.fileno(), fd_out_w, fd_kill_r])
+        except OSError:
+            logger.exception('Cannot send the run to the fork server')
+            if fd_out is not None:
+                os.close(fd_out)
+            os.close(fd_kill)
+            self.close()
+            return -1, False
+        finally:
+            if fd_out is not None:
+                os.close(fd_out_w)
+            os.close(fd_kill_r)
+
+        is_ole = False
+        with open(fd_kill, 'wb', buffering=0) as f_kill:
+            if fd_out is not None:
+                # the runner ends the output by killing what is left of the run
+                timeout = wall_secs + CLOSE_TIMEOUT if wall_secs else None
+                # the program gets SIGPIPE if it keeps writing after this is closed
+                with open(fd_out, 'rb', buffering=0):
+                    try:
+                        _, is_ole, aborted = pipes.copy_pipe(fd_out, dest, limit, timeout=timeout)
+                    except subprocess.TimeoutExpired:
+                        logger.error('Output of the run has not ended in %ds, killing it', timeout)
+                        aborted = True
+                if aborted:
+                    logger.debug('Output aborted by %r, killing the program', dest)
+                    try:
+                        f_kill.write(b'k')
+                    except BrokenPipeError:
+                        # it has exited already
+                        pass
+            returncode = self._readStats(log_file)
+
+        fails_after = self._failCount()
+        if fails_before is not None and fails_after is not None:
+            # more accurate than the guess of the runner
+            log_file.write('[S][0] __STAT__:0 cgroup_memory_failcnt = {}\n'.format(fails_after - fails_before))
+        usage = peak.stop() if peak is not None else None
+        if usage is not None:
+            # unlike the ru_maxrss of the runner, counts the children and the page cache
+            log_file.write('[S][0] __STAT__:0 cgroup_memory_max_usage = {}\n'.format(usage))
+        log_file.flush()
+        return returncode, is_ole
@@ -0,0 +1,320 @@
+import fcntl
+import grp
+import json
+import logging
+import os
+from os import path
+import pwd
+import selectors
+import shlex
+import signal
+import socket
+import subprocess
+
+from .utils import loadConfig
+
+'''
+A helper that starts sandboxes for the judge, so that the judge can run
+unprivileged and does not go through sudo for every run. It is started as
+root with `python3 -m hoj_judge helper`, listens on a Unix socket and then
+drops to the sandbox user; for every connection it starts nsjail with the
+arguments and fds it is sent, and reports back when nsjail exits. It only
+runs nsjail, and only as the sandbox user, so it allows no more than the
+sudoers rule it replaces. Only the group given in config can connect.
+
+Every message is a JSON object on a SOCK_SEQPACKET socket:
+
+    -> {"args": [...], "cwd": ..., "fds": [0, 1, 2, 5], "cpus": [1] or null}
+       with the fds attached, which nsjail gets under the numbers in "fds"
+    <- {"pid": ...} or {"error": ...}
+    -> {"signal": 15}, any number of times
+    <- {"returncode": ...}
+
+Closing the connection before that kills the sandbox.
+'''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = '/run/hoj-judge/helper.sock'
+SANDBOX_USER = 'nobody'
+# relative to this directory, as the configs passed to it
+NSJAIL_PATH = '../nsjail'
+MESSAGE_SIZE = 64 * 1024
+MAX_FDS = 16
+SANDBOX_ENV = {'PATH': '/usr/local/bin:/usr/bin:/bin'}
+# what the judge may send to a sandbox
+ALLOWED_SIGNALS = (signal.SIGTERM, signal.SIGKILL)
+
+# for security reasons, sudo closes fds that are larger by some integer (2 by default).
+# since we want to keep them in order to keep logs, we need to configure sudo to allow
+# exceptions to allow overriding this limitation
+cmd_sudo_tpl = 'sudo -C {fd_close_from} -u {user} -- {nsjail}'
+
+
+def _fileno(f, devnull):
+    if f is None or f == subprocess.DEVNULL:
+        return devnull
+    return f if isinstance(f, int) else f.fileno()
+
+
+def spawn(args, stdin=None, stdout=None, stderr=None, pass_fds=(), cpus=None):
+    '''Start nsjail with `args` as the sandbox user, through the helper if
+    [helper] socket is set in config and through sudo otherwise. The fds in
+    `pass_fds` keep their numbers. Returns a subprocess.Popen or, with the
+    helper, a HelperProcess.'''
+    cwd = path.dirname(path.abspath(__file__))
+    socket_path = loadConfig().get('helper', {}).get('socket')
+    if socket_path:
+        return HelperProcess(socket_path, args, cwd, stdin, stdout, stderr, pass_fds, cpus)
+
+    cmd = shlex.split(cmd_sudo_tpl.format(
+        fd_close_from=max(pass_fds, default=2) + 1,
+        user=SANDBOX_USER,
+        nsjail=NSJAIL_PATH
+    )) + list(args)
+    if cpus:
+        cmd = ['taskset', '-c', ','.join(map(str, sorted(cpus)))] + cmd
+    return subprocess.Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                            pass_fds=pass_fds)
+
+
+class HelperProcess(object):
+    '''A sandbox started by the helper, with the part of the interface of
+    subprocess.Popen that the judge uses.'''
+    def __init__(self, socket_path, args, cwd, stdin=None, stdout=None, stderr=None,
+                 pass_fds=(), cpus=None):
+        self.args = args
+        self.pid = None
+        self.returncode = None
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            self._sock.connect(socket_path)
+            fds = [_fileno(f, devnull) for f in (stdin, stdout, stderr)] + list(pass_fds)
+            req = {
+                'args': list(args),
+                'cwd': cwd,
+                'fds': [0, 1, 2] + list(pass_fds),
+                'cpus': sorted(cpus) if cpus else None,
+            }
+            socket.send_fds(self._sock, [json.dumps(req).encode()], fds)
+            reply = self._recv()
+        except:
+            self._sock.close()
+            raise
+        finally:
+            os.close(devnull)
+
+        if 'pid' not in reply:
+            self._sock.close()
+            raise OSError('The helper cannot start the sandbox: {}'.format(reply.get('error')))
+        self.pid = reply['pid']
+
+    def __repr__(self):
+        return '<HelperProcess pid={} returncode={}>'.format(self.pid, self.returncode)
+
+    def _recv(self, flags=0):
+        msg = self._sock.recv(MESSAGE_SIZE, flags)
+        if not msg:
+            raise ConnectionError('The helper has closed the connection')
+        return json.loads(msg)
+
+    def _finish(self, flags=0):
+        try:
+            self.returncode = self._recv(flags)['returncode']
+        except (BlockingIOError, socket.timeout):
+            raise
+        except (OSError, ValueError, KeyError):
+            logger.exception('Lost the sandbox %r', self)
+            self.returncode = -1
+        self._sock.close()
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                self._finish(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            self._sock.settimeout(timeout)
+            try:
+                self._finish()
+            except socket.timeout:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            finally:
+                if self.returncode is None:
+                    self._sock.settimeout(None)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                self._sock.send(json.dumps({'signal': int(sig)}).encode())
+            except OSError:
+                # it has exited and the helper has gone on
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class HelperServer(object):
+    '''The helper itself. It binds the socket as root, then becomes the sandbox
+    user for good and serves all connections in one thread, starting nsjail
+    with posix_spawn.'''
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, user=SANDBOX_USER, group=None,
+                 nsjail_path=None):
+        pw = pwd.getpwnam(user)
+        self.socket_path = socket_path
+        self.user = user
+        self.uid, self.gid = pw.pw_uid, pw.pw_gid
+        self.client_gid = grp.getgrnam(group).gr_gid if group else None
+        self.nsjail_path = nsjail_path or path.realpath(
+            path.join(path.dirname(__file__), NSJAIL_PATH))
+
+        self._sel = None
+        # connection -> pid of its sandbox
+        self._runs = {}
+        self._cpus = None
+
+    def __repr__(self):
+        return '<HelperServer {} runs={}>'.format(self.socket_path, len(self._runs))
+
+    def _listen(self):
+        if path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        os.makedirs(path.dirname(self.socket_path), exist_ok=True)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        listener.bind(self.socket_path)
+        # not writable by the sandbox user, which it keeps listening as
+        if self.client_gid is not None:
+            os.chown(self.socket_path, 0, self.client_gid)
+            os.chmod(self.socket_path, 0o660)
+        else:
+            os.chmod(self.socket_path, 0o600)
+        listener.listen()
+        return listener
+
+    def serve_forever(self):
+        listener = self._listen()
+        if os.geteuid() == 0:
+            os.initgroups(self.user, self.gid)
+            os.setgid(self.gid)
+            os.setuid(self.uid)
+        self._cpus = os.sched_getaffinity(0)
+
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(listener, selectors.EVENT_READ, self._accept)
+        logger.info('Helper listening on %s, running %s', self.socket_path, self.nsjail_path)
+        try:
+            while True:
+                for key, _ in self._sel.select():
+                    key.data(key.fileobj)
+        finally:
+            for conn in list(self._runs):
+                self._drop(conn)
+            self._sel.close()
+            listener.close()
+
+    def _accept(self, listener):
+        conn, _ = listener.accept()
+        self._sel.register(conn, selectors.EVENT_READ, self._receive)
+        self._runs[conn] = None
+
+    def _drop(self, conn):
+        pid = self._runs.pop(conn, None)
+        if pid is not None:
+            logger.debug('Connection closed, killing sandbox %d', pid)
+            os.kill(pid, signal.SIGKILL)
+        self._sel.unregister(conn)
+        conn.close()
+
+    def _send(self, conn, msg):
+        try:
+            conn.send(json.dumps(msg).encode())
+        except OSError:
+            logger.debug('Cannot reply to %r', conn, exc_info=True)
+
+    def _receive(self, conn):
+        try:
+            msg, fds, _, _ = socket.recv_fds(conn, MESSAGE_SIZE, MAX_FDS)
+        except OSError:
+            msg, fds = b'', []
+        try:
+            for fd in fds:
+                os.set_inheritable(fd, False)
+            if not msg:
+                self._drop(conn)
+                return
+
+            pid = self._runs[conn]
+            if pid is None:
+                self._start(conn, json.loads(msg), fds)
+            else:
+                sig = json.loads(msg).get('signal')
+                if sig in ALLOWED_SIGNALS:
+                    os.kill(pid, sig)
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logger.warning('Bad request: %s', err)
+            self._send(conn, {'error': str(err)})
+            self._drop(conn)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _start(self, conn, req, fds):
+        args = req['args']
+        targets = req['fds']
+        cpus = req.get('cpus')
+        if not all(isinstance(a, str) for a in args):
+            raise ValueError('arguments must be strings')
+        if (len(targets) != len(fds) or len(set(targets)) != len(targets)
+                or not {0, 1, 2} <= set(targets)
+                or not all(isinstance(t, int) and t >= 0 for t in targets)):
+            raise ValueError('bad fds {!r}'.format(targets))
+
+        # the copies are above all the numbers they are moved to, and are
+        # closed on exec
+        top = max(targets) + 1
+        moved = [fcntl.fcntl(fd, fcntl.F_DUPFD_CLOEXEC, top) for fd in fds]
+        try:
+            # the sandbox inherits the directory and the CPUs
+            os.chdir(req['cwd'])
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+            pid = os.posix_spawn(
+                self.nsjail_path, [self.nsjail_path] + args, SANDBOX_ENV,
+                file_actions=[(os.POSIX_SPAWN_DUP2, fd, target)
+                              for fd, target in zip(moved, targets)],
+                setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        finally:
+            if cpus:
+                os.sched_setaffinity(0, self._cpus)
+            for fd in moved:
+                os.close(fd)
+        logger.debug('Started sandbox %d: %r', pid, args)
+        self._runs[conn] = pid
+
+        pidfd = os.pidfd_open(pid)
+        self._sel.register(pidfd, selectors.EVENT_READ, lambda _: self._reap(conn, pid, pidfd))
+        self._send(conn, {'pid': pid})
+
+    def _reap(self, conn, pid, pidfd):
+        self._sel.unregister(pidfd)
+        os.close(pidfd)
+        _, status = os.waitpid(pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        logger.debug('Sandbox %d exited with %d', pid, returncode)
+        if self._runs.get(conn) == pid:
+            # it is gone, nothing to kill
+            self._runs[conn] = None
+            self._send(conn, {'returncode': returncode})
+            self._drop(conn)
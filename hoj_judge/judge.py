@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import io
 import logging
 import math
 import os
 from os import path
+import queue
 import re
 import resource
 import subprocess
@@ -17,19 +20,20 @@ from colors import color
 
 from google.protobuf.wrappers_pb2 import Int64Value
 import hoj_judge.models_hoj as m
+from . import cache
+from . import checkers
+from . import metrics
+from . import pch
 from . import protos
 from . import pipes
-from .utils import pformat
+from . import sandbox
+from . import testdata
+from .slots import DEFAULT_SLOT
+from .utils import loadConfig, pformat
 from ._hoj_helpers import *
 
 
-SANDBOX_PATH = '/run/shm/judge'
-TESTDATA_PATH = path.relpath(path.join(__package__, '..', 'testdata'))
-TMP_RUNLOG_PATH = '/run/shm/sandbox.log'
-TMP_USEROUT_PATH = '/tmp/test'
-TMP_COMPLOG_PATH = '/run/shm/compile.log'
-LOG_STDOUT_PATH = '/tmp/judge.stdout.log'
-LOG_STDERR_PATH = '/tmp/judge.stderr.log'
+TESTDATA_PATH = testdata.TESTDATA_PATH
 PROG_EXEC_PATH = './program'
 PROG_INTER_PATH = './interactor'
 
@@ -37,14 +41,7 @@ SOURCE_FILENAME = 'test-file.cpp'
 COMPILE_MEM_LIM = 128 * 1024 * 1024
 COMPILE_OUT_LIM = 8 * 1024
 USER_OUTPUT_LIM = 64 * 1024 * 1024  # 64MB is enough for most cases (?)
-
-# for security reasons, sudo closes fds that are larger by some integer (2 by default).
-# since we want to keep them in order to keep logs, we need to configure sudo to allow
-# exceptions to allow overriding this limitation
-cmd_task_tpl = ('sudo -C {fd_close_from} -u nobody '
-    '-- ../nsjail -C ../nsjail.cfg -D {cwd} '
-    '-t {time} --cgroup_mem_max {mem} --log_fd {log_fd} '
-    '-- {exec}')
+TMPDIR_PLACEHOLDER = '\0TMPDIR\0'
 
 cmd_compile_tpl = 'g++ -Wall -O2 -fdiagnostics-color=always -o {output} {src}'
 cmd_compile_checker_tpl = 'g++ -O2 -fdiagnostics-color=always -o {output} {src}'
@@ -52,20 +49,33 @@ cmd_compile_checker_tpl = 'g++ -O2 -fdiagnostics-color=always -o {output} {src}'
 logger = logging.getLogger(__name__)
 
 
-def taskCompile(cmd, journals):
+'''
+Get a judge option from the [judge] section of config. It can be overridden
+per problem in the [judge.problems.<problem id>] sections.
+'''
+def problemOption(problem, key, default=None):
+    conf = loadConfig().get('judge', {})
+    overrides = conf.get('problems', {}).get(str(problem.problem), {})
+    return overrides.get(key, conf.get(key, default))
+
+
+def judgeOption(key, default=None):
+    return loadConfig().get('judge', {}).get(key, default)
+
+
+def taskCompile(cmd, journals, cwd=DEFAULT_SLOT.sandbox_path):
     logger.debug('Starting subproc for task compiling: %r', cmd)
 
     def preexec():
         resource.setrlimit(resource.RLIMIT_AS, (COMPILE_MEM_LIM, COMPILE_MEM_LIM))
 
-    t = time.perf_counter()
     subp, ole = pipes.run_with_pipes(
         cmd,
-        cwd=SANDBOX_PATH,
+        cwd=cwd,
         preexec_fn=preexec,
         pipe_stderr=(journals[1], COMPILE_OUT_LIM),
     )
-    logger.debug('Ending subproc for task compiling after %.0fms', (time.perf_counter() - t) * 1000)
+    logger.debug('Ending subproc for task compiling')
 
     msg = journals[1]._read()
 
@@ -77,124 +87,164 @@ def taskCompile(cmd, journals):
     return subp, ole[0] or ole[1]
 
 
-def taskCompileChecker(problem, checker_out, checker_exec):
-    with open(checker_out, 'w') as f:
-        f.write(problem.problem_check)
-
+'''
+Compile with `cmd` unless a compilation with the same `key` is cached, in
+which case the program and the compiler messages are restored from the cache
+instead. `tmpdir` is where the sources are, which is substituted in messages.
+'''
+def taskCompileCached(cmd, journals, cwd, key, output, tmpdir, tag='COMPILE'):
+    store = cache.getCache('compile')
+    if store is None:
+        with journals.start(None, tag):
+            return taskCompile(cmd, journals, cwd)
+
+    with store.lock(key):
+        entry = store.get(key)
+        if entry is not None:
+            try:
+                meta = store.meta(entry)
+                if meta['returncode'] == 0:
+                    copyFresh(path.join(entry, 'program'), output)
+            except (OSError, ValueError):
+                logger.warning('Broken compile cache entry %s, compiling anyway', entry, exc_info=True)
+            else:
+                logger.debug('Compile cache hit: %s', key)
+                with journals.start(None, tag):
+                    journals[1].write(meta['log'].replace(TMPDIR_PLACEHOLDER, tmpdir).encode())
+                return subprocess.CompletedProcess(cmd, meta['returncode']), meta['is_ole']
+
+        with journals.start(None, tag):
+            subp, is_ole = taskCompile(cmd, journals, cwd)
+
+        # a negative code means being killed, which might not be reproducible
+        if subp.returncode >= 0:
+            store.put(key, {'program': output} if subp.returncode == 0 else {}, {
+                'returncode': subp.returncode,
+                'is_ole': is_ole,
+                'log': journals[1].dump(tag).replace(tmpdir, TMPDIR_PLACEHOLDER),
+            })
+        return subp, is_ole
+
+
+def copyFresh(src, dest):
+    # replace rather than overwrite, as `dest` may be linked or running elsewhere
+    if path.lexists(dest):
+        os.remove(dest)
+    shutil.copy2(src, dest)
+
+
+def taskCompileChecker(problem, checker_out, checker_exec, cwd=DEFAULT_SLOT.sandbox_path):
+    include_path = path.realpath('include')
     cmd_compile_special = cmd_compile_checker_tpl.format(
         src=shlex.quote(checker_out),
         output=checker_exec
     )
+    cmd_compile_special = shlex.split(cmd_compile_special)
 
-    subp = subprocess.run(
-        shlex.split(cmd_compile_special) + ['-I' + path.realpath('include')],
-        cwd=SANDBOX_PATH  # should be JUDGE_ROOT
-    )
-    if subp.returncode != 0:
-        raise Exception('Failed to compile checker')
+    def compileChecker():
+        with open(checker_out, 'w') as f:
+            f.write(problem.problem_check)
 
-
-def judgeSingleSubtask(task, paths, checker_args):
+        with pch.includeArgs(cmd_compile_checker_tpl, pch.CHECKER_HEADERS,
+                             [include_path]) as pch_args:
+            subp = subprocess.run(
+                cmd_compile_special + pch_args + ['-isystem', include_path],
+                cwd=cwd  # should be JUDGE_ROOT
+            )
+        if subp.returncode != 0:
+            raise Exception('Failed to compile checker')
+
+    store = cache.getCache('checker')
+    if store is None:
+        return compileChecker()
+
+    # the checker changes only if its source, testlib or the compiler does
+    key = cache.digest(
+        cmd_compile_checker_tpl, cache.compilerVersion(cmd_compile_special[0]),
+        problem.problem_check, cache.fileDigest(path.join(include_path, 'testlib.h')))
+
+    # judges of the same problem wait for the one compiling the checker
+    with store.lock(key):
+        entry = store.get(key)
+        if entry is not None:
+            try:
+                copyFresh(path.join(entry, 'checker'), checker_exec)
+                logger.debug('Checker cache hit: %s', key)
+                return
+            except OSError:
+                logger.warning('Broken checker cache entry %s, compiling anyway', entry, exc_info=True)
+
+        compileChecker()
+        store.put(key, {'checker': checker_exec})
+
+
+def judgeSingleSubtask(task, paths, checker, box):
     infile, outfile = paths
-
-    log_file = open(TMP_RUNLOG_PATH, 'w+')
-    # the file is possibly not owned by the user executing task (via sudo),
-    # and latter writing will fail
-    os.chmod(TMP_RUNLOG_PATH, 0o666)
-    log_file_fd = log_file.fileno()
-
-    cmd_task_str = cmd_task_tpl.format(
-        cwd=shlex.quote(path.realpath(SANDBOX_PATH)),
-        time=math.ceil(task.time_limit / 1000),
-        mem=math.ceil(task.mem_limit * 1024),
-        log_fd=log_file_fd,
-        fd_close_from=log_file_fd + 1,
-        exec=PROG_EXEC_PATH
-    )
-    cmd_task = shlex.split(cmd_task_str)
+    slot = box.slot
 
     f_in = open(infile, 'r')
     # No, you really can't trust the user's output
-    f_out_user = open(TMP_USEROUT_PATH, 'w+b')
-
+    userout_path = slot.output_path if box.direct_output else slot.userout_path
+    f_out_user = open(userout_path, 'w+b')
+    # compare while the program runs if the checker can, killing it early;
+    # direct outputs are checked once the program is done
+    stream = None
+    if hasattr(checker, 'stream') and not box.direct_output:
+        stream = checker.stream(outfile, tee=f_out_user)
+
+    start_task = time.time()
     time_task = time.perf_counter()
 
-    logger.debug('Starting subproc for subtask: %r', cmd_task)
+    error = None
+    try:
+        result = box.run(f_in, stream or f_out_user, task.time_limit,
+                         math.ceil(task.mem_limit * 1024), USER_OUTPUT_LIM)
+    except sandbox.SandboxError as err:
+        result, error = None, err
 
-    subp_task, (is_stdout_ole, _) = pipes.run_with_pipes(
-        cmd_task,
-        cwd=path.dirname(__file__),
-        stdin=f_in,
-        pipe_stdout=(f_out_user, USER_OUTPUT_LIM),
-        stderr=subprocess.DEVNULL,
-        pass_fds=(log_file_fd,)
-    )
-
-    logger.debug('Ending subproc for subtask after %.0fms', (time.perf_counter() - time_task) * 1000)
-
-    process_failed = (subp_task.returncode != 0)
-    if process_failed:
-        logger.debug('Subtask {} with return code %d'.format(color('failed', fg='yellow')), subp_task.returncode)
+    metrics.record('run', time.perf_counter() - time_task, start_task, {'label': task.label})
 
     f_in.close()
     f_out_user.close()
+    if stream is not None:
+        stream.finish()
+        stream.close()
+
+    if error is not None:
+        logger.error('%s', error)
+        print(color('===== SER =====', fg='white', style='negative') +
+            ' SANDBOX_FAILED')
+        return HojVerdict.SERR, error.stats
 
-    # parse output and filter out the STATs key-value pair
-
-    # get size of the log
-    # TODO: interrupt if the log file is empty. the worker probably fails to start up
-    log_file.seek(0, os.SEEK_END)
-    sz = log_file.tell()
-
-    log_file.seek(0)
-    log_dict = {}
-    for ln in log_file:
-        mat = re.match(r'\[S\]\[\d+?\] __STAT__:0 (?:\d+?:)?([\w]+)\s+=\s+(.*)', ln)
-        if mat is None:
-            # TODO: triage the message to separate file
-            logger.debug('SANDBOX >>> %s', ln[:-1])
-            continue
-        log_dict[mat.group(1)] = mat.group(2)
-    log_file.close()
-
-    logger.debug('captured stat dict:\n%s', pformat(log_dict))
-
-    log_used_keys = [
-        'cgroup_memory_failcnt',
-        'cgroup_memory_max_usage',
-        'exit_normally',
-        'time'
-    ]
-
-    for k in log_used_keys:
-        if k not in log_dict:
-            logger.error('Cannot find key "%s" form log, which is mandatory', k)
-            print(color('===== SER =====', fg='white', style='negative') +
-                ' MISSING_KEY')
-            return HojVerdict.SERR, log_dict
-
-    time_used = int(log_dict['time'])
-    mem_used = int(log_dict['cgroup_memory_max_usage'])
-    is_seccomp_violating = (log_dict.get('seccomp_violation', '') != 'false')
-
-    if is_seccomp_violating:
+    log_dict = result.stats
+    if result.returncode != 0:
+        logger.debug('Subtask {} with return code %d'.format(color('failed', fg='yellow')), result.returncode)
+
+    if result.seccomp_violation:
         print(color('===== RF =====', fg='yellow', style='negative'))
         return HojVerdict.RF, log_dict
 
-    if is_stdout_ole:
-        # looks like nsjail ignores SIGPIPE and let children continue to run
-        # until TLE, because of the pid-namespace :(
+    if stream is not None and stream.aborted:
+        # whatever the sandbox reports after this is caused by the kill
+        verdict = HojVerdict.WA
+        if result.memory_exceeded:
+            verdict = HojVerdict.MLE
+        print(color('===== {:3} ====='.format(verdict.name), fg='red', style='negative') +
+              '  @ line {} (terminated early)'.format(stream.diff_at + 1))
+        return verdict, log_dict
+
+    if result.output_exceeded:
         print(color('===== OLE =====', style='negative'))
         return HojVerdict.OLE, log_dict
 
     # check if the process ends with error
     verdict = None
 
-    if log_dict['cgroup_memory_failcnt'] != '0':
+    if result.memory_exceeded:
         verdict = HojVerdict.MLE
-    elif (log_dict['exit_normally'] == 'false' and time_used >= task.time_limit):
+    elif result.time_exceeded:
         verdict = HojVerdict.TLE
-    elif process_failed:
+    elif result.returncode != 0:
         verdict = HojVerdict.RE
 
     if verdict is not None:
@@ -209,38 +259,18 @@ def judgeSingleSubtask(task, paths, checker_args):
             'mem_limit': task.mem_limit,
             'input_path': infile,
             'output_path': outfile,
-            'output_user_path': TMP_USEROUT_PATH,
+            'output_user_path': userout_path,
         },
         stat={
-            'time_used': time_used,
-            'mem_used': mem_used,
+            'time_used': result.time,
+            'mem_used': result.memory,
         },
         log_dict=log_dict,
     )
 
-    subp_checker = subprocess.run(
-        checker_args,
-        input=cxt.SerializeToString(),
-        stdout=subprocess.PIPE
-        # TODO: triage stderr; use alt. way to execute (if possible) to integrate log
-    )
-
-    resp = protos.subtask_response_pb2.SubtaskResponse()
-    if subp_checker.returncode == 0:
-        # the method name is confusing; it is in fact a byte string
-        try:
-            resp.ParseFromString(subp_checker.stdout)
-        except:
-            logger.exception('Error occurred when attempting to parse the response from the checker')
-            resp.verdict = HojVerdict.SERR.value
-    else:
-        logger.error('The checker exits abnormally with return code %d', subp_checker.returncode)
-        resp.verdict = HojVerdict.SERR.value
-
-    # alternative way for a Python file; faster
-    # import runpy
-    # tolerantDiff = runpy.run_path(checker_path)
-    # resp = tolerantDiff['main'](cxt)
+    logger.debug('Checking with %r', checker)
+    with metrics.span('check', label=task.label):
+        resp = checker.check(cxt) if stream is None else checker.check(cxt, stream)
 
     if resp.verdict == HojVerdict.WA.value:
         lineno_wrap = Int64Value(value=-1)
@@ -259,9 +289,10 @@ def judgeSingleSubtask(task, paths, checker_args):
     return HojVerdict(resp.verdict), log_dict
 
 
-def judgeSubmission(submission, judge_desc):
+def judgeSubmission(submission, judge_desc, slot=DEFAULT_SLOT):
     problem = submission.problem
-    logger.debug('Sandbox path is set to {}'.format(SANDBOX_PATH))
+    logger.debug('Judging in slot %r', slot)
+    slot.prepare()
 
     logger.debug('--- Judge Description ---\n%s', pformat(dict(judge_desc._asdict())))
 
@@ -271,17 +302,32 @@ def judgeSubmission(submission, judge_desc):
 
     print(color('--- Initializing...', style='bold'))
     logger.info(color('Checking test data...', style='bold'))
-    testdata_path_tpl = lambda label, ext: path.join(TESTDATA_PATH, '{}/{}.{}'.format(problem.problem, label, ext))
-    _testdata, testdata_healthy = hoj_collect_testdata(all_tasks, testdata_path_tpl)
-    if not testdata_healthy:
-        logger.error(color('Failed to collect test data, refusing to continue', fg='red', style='bold'))
-        return None, -1, None
+    with contextlib.ExitStack() as stack:
+        with metrics.span('testdata'):
+            manifest = testdata.manifest(problem.problem, TESTDATA_PATH)
+            # staged test data stays until the submission is judged
+            testdata_dir = stack.enter_context(testdata.stage(problem.problem, manifest))
+            _testdata, testdata_healthy = hoj_collect_testdata(judge_desc.testdata_files, testdata_dir,
+                lambda p: manifest.has(path.basename(p)))
+        if not testdata_healthy:
+            logger.error(color('Failed to collect test data, refusing to continue', fg='red', style='bold'))
+            return None, -1, None
+
+        # prepare logging facilities; the logs only go to disk if they are long
+        journals = pipes.Journals(
+            pipes.MemoryJournal(spill_path=slot.log_stdout_path),
+            pipes.MemoryJournal(spill_path=slot.log_stderr_path))
+        try:
+            return _judgeSubmission(submission, judge_desc, _testdata, manifest, journals, slot)
+        finally:
+            journals.close()
 
-    # prepare logging facilities
-    logfile_stdout = open(LOG_STDOUT_PATH, 'w+')
-    logfile_stderr = open(LOG_STDERR_PATH, 'w+')
 
-    journals = pipes.Journals(logfile_stdout, logfile_stderr)
+def _judgeSubmission(submission, judge_desc, _testdata, manifest, journals, slot):
+    problem = submission.problem
+    samples = judge_desc.samples
+    subtasks = judge_desc.subtasks
+    all_tasks = samples + subtasks
 
     logger.info(color('Writing code to disk...', style='bold'))
 
@@ -289,7 +335,7 @@ def judgeSubmission(submission, judge_desc):
     print('tmpdir', tmpdir)
 
     path_src = path.join(tmpdir, SOURCE_FILENAME)
-    path_prog_out = path.join(SANDBOX_PATH, PROG_EXEC_PATH)
+    path_prog_out = path.join(slot.sandbox_path, PROG_EXEC_PATH)
 
     with open(path_src, 'w') as f:
         nwrt = f.write(submission.submission_code)
@@ -306,6 +352,7 @@ def judgeSubmission(submission, judge_desc):
             'user.c']
 
         supp_hdr, supp_user = [ shutil.copy(path.join(path_supp_dir, x), tmpdir) for x in copying_files ]
+        supp_files = [supp_hdr, supp_user]
 
         srcs = ' '.join([shlex.quote(x) for x in (path_src, supp_user)])
         cmd_compile = cmd_compile_tpl.format(
@@ -313,13 +360,22 @@ def judgeSubmission(submission, judge_desc):
             output=shlex.quote(path_prog_out),
         )
     else:
+        supp_files = []
         cmd_compile = cmd_compile_tpl.format(
             src=shlex.quote(path_src),
             output=shlex.quote(path_prog_out),
         )
 
-    with journals.start(None, 'COMPILE'):
-        subp_compile, is_ole = taskCompile(shlex.split(cmd_compile), journals)
+    # the precompiled headers must stay until the compile is done with them
+    with pch.includeArgs(cmd_compile_tpl, pch.SUBMISSION_HEADERS) as pch_args:
+        cmd_compile = shlex.split(cmd_compile) + pch_args
+        compile_key = cache.digest(
+            cmd_compile_tpl, cache.compilerVersion(cmd_compile[0]),
+            str(COMPILE_MEM_LIM), str(COMPILE_OUT_LIM),
+            submission.submission_code, cache.fileDigest(*supp_files))
+        with metrics.span('compile'):
+            subp_compile, is_ole = taskCompileCached(
+                cmd_compile, journals, slot.sandbox_path, compile_key, path_prog_out, tmpdir)
 
     _comp_stderr = journals[1].dump('COMPILE')
     ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -/]*[@-~]')
@@ -343,48 +399,147 @@ def judgeSubmission(submission, judge_desc):
         return [[HojVerdict.CE, 0, 0] for _ in all_tasks], 0, log_msg
 
 
+    in_process = problemOption(problem, 'in_process_checkers', True)
+
     if is_interactive:
         logger.debug('Interactive judge is on')
         print(color('Interactive judge. Compiling interactor...', style='bold'))
 
-        path_inter_out = path.join(SANDBOX_PATH, PROG_INTER_PATH)
+        path_inter_out = path.join(slot.sandbox_path, PROG_INTER_PATH)
         with journals.start(None, 'COMPILE_INTER'):
             cmd_compile_2 = cmd_compile_tpl.format(
                 src=path.abspath(path.join(path_supp_dir, 'interactor.c')),
                 output=shlex.quote(path_inter_out),
             )
-            subp_compile_2, _ = taskCompile(shlex.split(cmd_compile_2), journals)
+            subp_compile_2, _ = taskCompile(shlex.split(cmd_compile_2), journals, slot.sandbox_path)
 
         if subp_compile_2.returncode != 0:
             print(color('Failed to compile interactor', fg='red', style='bold'))
             return [[HojVerdict.OTHER, 0, 0] for _ in all_tasks], 0, log_msg
         # FIXME
-        checker_args = [path.join(__package__, '..', 'utils', 'interactive.py')]
+        makeChecker = lambda _: checkers.resolve('interactive', in_process=False)
     elif problem.problem_special:
         logger.debug('Special judge is on')
         print(color('Special judge. Compiling checker...', style='bold'))
 
-        checker_out = '/tmp/special.cpp'
-        checker_exec = '/run/shm/checker'
+        checker_out = slot.checker_src_path
+        checker_exec = slot.checker_path
+
+        with metrics.span('compile_checker'):
+            taskCompileChecker(problem, checker_out, checker_exec, slot.sandbox_path)
+
+        makeChecker = lambda s: checkers.resolve(
+            'hoj_special_judge', checker_exec, s.work_path, in_process=in_process)
+    elif problemOption(problem, 'streaming_diff', False):
+        makeChecker = lambda _: checkers.StreamingDiffChecker(
+            checkers.resolve('tolerant_diff', in_process=in_process))
+    elif problemOption(problem, 'fingerprints', False):
+        makeChecker = lambda _: checkers.FingerprintChecker(
+            checkers.resolve('tolerant_diff', in_process=in_process),
+            lambda p: manifest.get(path.basename(p)))
+    else:
+        makeChecker = lambda _: checkers.resolve('tolerant_diff', in_process=in_process)
+
+    # one sandbox per lane; with the fork server, one jail runs all the tests
+    # of a lane, which interactive problems do not support
+    boxes = []
+    def makeSandbox(s):
+        boxes.append(sandbox.create(
+            problemOption(problem, 'sandbox', 'nsjail'), s, PROG_EXEC_PATH,
+            fork_server=not is_interactive and problemOption(problem, 'forkserver', False),
+            time_source=judgeOption('time_source', 'wall'),
+            wall_time_factor=judgeOption('wall_time_factor', sandbox.WALL_TIME_FACTOR),
+            direct_output=problemOption(problem, 'direct_output', False)))
+        return boxes[-1]
+
+    # the interactor is not meant to be run concurrently (yet)
+    num_lanes = 1 if is_interactive else problemOption(problem, 'parallel_tests', 1)
+    if num_lanes > 1:
+        logger.debug('Running tests in %d lanes', num_lanes)
+        lanes = slot.lanes(num_lanes)
+        for lane in lanes:
+            lane.adopt(slot, PROG_EXEC_PATH)
+        runner = ParallelTaskRunner(lanes, makeChecker, makeSandbox)
+        task_results = runner.run(all_tasks, _testdata)
+    else:
+        runner = None
+        checker = makeChecker(slot)
+        box = makeSandbox(slot)
+        task_results = [LazyResult(judgeSingleSubtask, task, paths, checker, box)
+                        for task, paths in zip(all_tasks, _testdata)]
+
+    fast_fail = problemOption(problem, 'fast_fail', False)
+    try:
+        return _judgeTasks(judge_desc, task_results, log_msg, fast_fail)
+    finally:
+        if runner is not None:
+            runner.close()
+        for box in boxes:
+            box.close()
+
+
+class LazyResult(object):
+    '''The result of a test that runs only when asked for. It behaves like the
+    futures of ParallelTaskRunner as far as _judgeTasks is concerned.'''
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+        self._done = False
+        self._result = None
+
+    def result(self):
+        if not self._done:
+            self._result = self._func(*self._args)
+            self._done = True
+        return self._result
+
+    def cancel(self):
+        return not self._done
+
+
+class ParallelTaskRunner(object):
+    '''Run tests in several lanes at the same time. Results are still yielded
+    in the order of the tests.'''
+    def __init__(self, lanes, makeChecker, makeSandbox):
+        self._lanes = queue.Queue()
+        for lane in lanes:
+            self._lanes.put(makeSandbox(lane))
+        self._pool = ThreadPoolExecutor(len(lanes))
+        self._makeChecker = makeChecker
+
+    def _run(self, task, paths):
+        box = self._lanes.get()
+        try:
+            return judgeSingleSubtask(task, paths, self._makeChecker(box.slot), box)
+        finally:
+            self._lanes.put(box)
+
+    def run(self, tasks, testdata):
+        '''Start running `tasks`. Returns a future for each of them.'''
+        return [self._pool.submit(self._run, task, paths)
+                for task, paths in zip(tasks, testdata)]
 
-        taskCompileChecker(problem, checker_out, checker_exec)
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
 
-        checker_args = [
-            path.join(__package__, '..', 'utils', 'hoj_special_judge.py'),
-            checker_exec
-        ]
-    else:
-        checker_args = [path.join(__package__, '..', 'utils', 'tolerant_diff.py')]
+
+def _judgeTasks(judge_desc, task_results, log_msg, fast_fail=False):
+    '''Collect the results of the tests and score the groups. `task_results`
+    has a future-like object for each test. With `fast_fail`, the tests left in
+    a group that has failed are cancelled and marked as SKIPPED when possible.'''
+    samples = judge_desc.samples
+    subtasks = judge_desc.subtasks
+    task_results = list(task_results)
+    next_result = iter(task_results)
 
     print(color('--- Sample judging tasks', style='bold'))
 
-    testdata_iter = iter(_testdata)
     judge_results = []
     pretest_fail = False
 
     for task in samples:
         logger.info('------ Start judge sample: %r ------', task)
-        verdict, info = judgeSingleSubtask(task, next(testdata_iter), checker_args)
+        verdict, info = next(next_result).result()
 
         judge_results.append([
             verdict,
@@ -398,45 +553,44 @@ def judgeSubmission(submission, judge_desc):
     if pretest_fail:
         print('Error occurred when running samples -- halting')
         results = judge_results + [[HojVerdict.OTHER, -1, -1] for _ in subtasks]
-        return results, 0
+        return results, 0, log_msg
 
     print(color('--- Real judging tasks', style='bold'))
 
     score_total = 0
 
-    group_num = 0
-    task_group_iter = iter(judge_desc.task_groups)
-
-    cur_group_no = 0
-    cur_group_count, cur_group_score = None, 0
-    cur_group_accepted = True
-
-    for task in subtasks:
-        if cur_group_count is None:
-            cur_group_count, cur_group_score = next(task_group_iter)
-            group_num += 1
-            cur_group_no = 0
-            cur_group_accepted = True
-
-        logger.info('------ Start judge subtask (%s, %s/%s): %r ------',
-            group_num, cur_group_no + 1, cur_group_count, task)
-
-        verdict, info = judgeSingleSubtask(task, next(testdata_iter), checker_args)
-        if verdict != HojVerdict.AC and not task.fallthrough:
-            cur_group_accepted = False
-
-        judge_results.append([
-            verdict,
-            int(info.get('time', -1)),
-            int(info.get('cgroup_memory_max_usage', -1))
-        ])
-
-        cur_group_no += 1
-        if cur_group_no >= cur_group_count:
-            score = cur_group_score if cur_group_accepted else 0
-            score_total += score
-            cur_group_count = None
-            logger.info('End of group, giving score {}/{}'.format(score, cur_group_score))
+    for group_num, (start, end, group_score) in enumerate(judge_desc.group_bounds, 1):
+        group_accepted = True
+
+        for i in range(start, end):
+            task = subtasks[i]
+            logger.info('------ Start judge subtask (%s, %s/%s): %r ------',
+                group_num, i - start + 1, end - start, task)
+
+            result = next(next_result)
+            if fast_fail and not group_accepted and result.cancel():
+                print(color('===== SKIPPED =====', style='faint') + ' GROUP_FAILED')
+                judge_results.append([HojVerdict.SKIPPED, 0, 0])
+                continue
+
+            verdict, info = result.result()
+            if verdict != HojVerdict.AC and not task.fallthrough:
+                if fast_fail and group_accepted:
+                    # keep the tests left in the group from being started
+                    offset = len(samples)
+                    for rest in task_results[offset + i + 1:offset + end]:
+                        rest.cancel()
+                group_accepted = False
+
+            judge_results.append([
+                verdict,
+                int(info.get('time', -1)),
+                int(info.get('cgroup_memory_max_usage', -1))
+            ])
+
+        score = group_score if group_accepted else 0
+        score_total += score
+        logger.info('End of group, giving score {}/{}'.format(score, group_score))
 
     # note that the log is sent back even if the compilation succeeds
     return judge_results, score_total, log_msg
@@ -0,0 +1,147 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+from os import path
+import tempfile
+import threading
+import time
+
+from .utils import loadConfig
+
+'''
+Timing of the stages of judging. Every stage is measured as a span, which is
+tagged with the submission, problem and slot being judged (see `context()`)
+and, for the runs of tests, the label of the test. Spans are aggregated into a
+histogram per stage, and exported as configured in the [metrics] section:
+each span as a JSON line, and the histograms in the Prometheus text format,
+rewritten after each submission for e.g. the textfile collector of
+node_exporter.
+
+A process judges one submission at a time, so the context is shared by the
+threads running its tests.
+'''
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC_NAME = 'hoj_judge_stage_seconds'
+
+_context = {}
+_histograms = {}
+_lock = threading.Lock()
+_spans_file = None
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self):
+        return '<Histogram count={} sum={:.3f}>'.format(self.count, self.sum)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+@contextlib.contextmanager
+def context(**tags):
+    '''Tag the spans within with `tags`, e.g. submission=, problem= and slot=.'''
+    global _context
+    saved = _context
+    _context = dict(saved, **tags)
+    try:
+        yield
+    finally:
+        _context = saved
+
+
+def tag(**tags):
+    '''Add `tags` to the innermost context.'''
+    _context.update(tags)
+
+
+@contextlib.contextmanager
+def span(stage, **tags):
+    '''Measure the block within as a span of `stage`.'''
+    start = time.time()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - t, start, tags)
+
+
+def record(stage, seconds, start=None, tags={}):
+    tags = dict(_context, **tags)
+    logger.debug('Span %s took %.0fms %r', stage, seconds * 1000, tags)
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = Histogram()
+        hist.observe(seconds)
+        _writeSpan(dict(tags, stage=stage, start=start, seconds=round(seconds, 6), pid=os.getpid()))
+
+
+def _writeSpan(entry):
+    global _spans_file
+    if _spans_file is None:
+        spans_path = loadConfig().get('metrics', {}).get('spans_path')
+        if not spans_path:
+            _spans_file = False
+            return
+        try:
+            # one write per line, so that lines of the workers do not mix
+            _spans_file = open(spans_path, 'a', buffering=1)
+        except OSError:
+            logger.warning('Cannot open %s to write spans to', spans_path, exc_info=True)
+            _spans_file = False
+    if _spans_file:
+        _spans_file.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def formatPrometheus(histograms):
+    lines = [
+        '# HELP {} Time spent in each stage of judging.'.format(METRIC_NAME),
+        '# TYPE {} histogram'.format(METRIC_NAME),
+    ]
+    for stage in sorted(histograms):
+        hist = histograms[stage]
+        labels = 'stage="{}"'.format(stage)
+        cumulative = 0
+        for le, n in zip(hist.buckets + ('+Inf',), hist.counts):
+            cumulative += n
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(METRIC_NAME, labels, le, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(METRIC_NAME, labels, hist.sum))
+        lines.append('{}_count{{{}}} {}'.format(METRIC_NAME, labels, hist.count))
+    return '\n'.join(lines) + '\n'
+
+
+def export():
+    '''Rewrite the histograms to `prometheus_path` of [metrics], where {slot}
+    is replaced by the index of the slot in context.'''
+    prom_path = loadConfig().get('metrics', {}).get('prometheus_path')
+    if not prom_path:
+        return
+    prom_path = prom_path.format(slot=_context.get('slot', 0))
+    with _lock:
+        text = formatPrometheus(_histograms)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(prom_path)), prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, prom_path)
+        except:
+            os.remove(tmp)
+            raise
+    except OSError:
+        logger.warning('Cannot write metrics to %s', prom_path, exc_info=True)
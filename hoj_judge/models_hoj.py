@@ -2,11 +2,13 @@ import logging
 import os
 
 from peewee import *
+from peewee import FieldAccessor
 
 
 DATABASE = Proxy()
 LOGGER_PEEWEE = logging.getLogger('peewee')
 LOGGER_PEEWEE.setLevel(logging.WARNING)
+CLAIM_LOCK_TPL = 'hoj_judge.submission.{}'
 
 def init(database_):
     DATABASE.initialize(database_)
@@ -20,20 +22,97 @@ def init(database_):
 def connection_context():
     return DATABASE.connection_context()
 
+# ids in `exclude` are skipped by the query itself, so that they cannot take
+# up the whole page
+def pending_submissions(limit=None, exclude=()):
+    query = (Submission
+             .select(Submission.submission)
+             .where(Submission.submission_status == 0)
+             .order_by(Submission.submission)
+             .limit(limit))
+    if exclude:
+        query = query.where(Submission.submission.not_in(list(exclude)))
+    return [s.submission for s in query]
+
+# MySQL named locks are bound to the connection holding them, so a claim is
+# released automatically if the worker dies or loses its connection
+def claim_submission(id):
+    cursor = DATABASE.execute_sql('SELECT GET_LOCK(%s, 0)', (CLAIM_LOCK_TPL.format(id),))
+    return cursor.fetchone()[0] == 1
+
+def release_submission(id):
+    DATABASE.execute_sql('SELECT RELEASE_LOCK(%s)', (CLAIM_LOCK_TPL.format(id),))
+
+# how many times the database has replaced a lost connection by itself, which
+# takes the claims of the connection along; 0 for databases that do not
+def reconnect_count():
+    return getattr(DATABASE, 'reconnects', 0)
+
+def submission_statuses(ids):
+    query = (Submission
+             .select(Submission.submission, Submission.submission_status)
+             .where(Submission.submission.in_(list(ids))))
+    return {s.submission: s.submission_status for s in query}
+
+# only what judging needs, with the problem joined in; `problem` is None if the
+# problem is missing, which is left to the judge to fail on
+def judge_submission(id):
+    return (Submission
+            .select(Submission.submission, Submission.problem, Submission.submission_code,
+                    Submission.submission_status,
+                    Problem.problem, Problem.problem_testdata, Problem.problem_special,
+                    Problem.problem_check)
+            .join(Problem, JOIN.LEFT_OUTER)
+            .where(Submission.submission == id)
+            .get())
+
+# `updates` maps submission ids to {field name: value}; one UPDATE is issued
+# for all of them, each column taking its value from a CASE on the id
+def update_submissions(updates):
+    names = sorted(set().union(*updates.values()))
+    columns = {}
+    for name in names:
+        field = Submission._meta.fields[name]
+        cases = [(id, field.db_value(update[name]))
+                 for id, update in updates.items() if name in update]
+        columns[field] = Case(Submission.submission, cases, field)
+    return (Submission
+            .update(columns)
+            .where(Submission.submission.in_(list(updates)))
+            .execute())
+
+
+def parse_tabular(value):
+    if value == '' or value is None: return []
+    lines = value.strip().split('\n')
+    try:
+        return [[int(c) for c in l.split()] for l in lines]
+    except ValueError:
+        return lines
 
 class TabularIntgralField(TextField):
     __listToLineStr = lambda x: ' '.join(map(str, x)) + '\n'
-    __lineToIntList = lambda l: [int(c) for c in l.strip().split(' ')]
 
     def db_value(self, value):
         return ''.join(map(TabularIntgralField.__listToLineStr, value))
     def python_value(self, value):
-        if value == '' or value is None: return []
-        try:
-            return list(map(TabularIntgralField.__lineToIntList,
-                            value.strip().split('\n')))
-        except:
-            return list(value.strip().split('\n'))
+        return parse_tabular(value)
+
+
+class DeferredFieldAccessor(FieldAccessor):
+    def __get__(self, instance, instance_type=None):
+        if (instance is not None and self.name not in instance.__data__
+                and instance._pk is not None):
+            model = type(instance)
+            instance.__data__[self.name] = (model
+                .select(self.field)
+                .where(model._meta.primary_key == instance._pk)
+                .scalar())
+        return super().__get__(instance, instance_type)
+
+# large text, fetched when first accessed if it has been left out of the query
+class DeferredTextField(TextField):
+    accessor_class = DeferredFieldAccessor
 
 
 '''
@@ -47,7 +126,7 @@ class BaseModel(Model):
 
 class Contest(BaseModel):
     contest = AutoField(column_name='contest_id')
-    contest_description = TextField(null=True)
+    contest_description = DeferredTextField(null=True)
     contest_end = DateTimeField()
     contest_feedback = IntegerField(default=0)
     contest_level = IntegerField(default=1)
@@ -82,18 +161,19 @@ class User(BaseModel):
 class Problem(BaseModel):
     problem = AutoField(column_name='problem_id')
     problem_check = TextField(null=True)
-    problem_description = TextField(null=True)
-    problem_hint = TextField(null=True)
-    problem_input = TextField(null=True)
+    problem_description = DeferredTextField(null=True)
+    problem_hint = DeferredTextField(null=True)
+    problem_input = DeferredTextField(null=True)
     problem_level = IntegerField(default=0)
-    problem_output = TextField(null=True)
-    problem_samplein = TextField(null=True)
-    problem_sampleout = TextField(null=True)
+    problem_output = DeferredTextField(null=True)
+    problem_samplein = DeferredTextField(null=True)
+    problem_sampleout = DeferredTextField(null=True)
     problem_setter = IntegerField(default=1)
     problem_source = CharField(null=True)
     problem_special = IntegerField(default=0, null=True)
-    problem_task = TextField(null=True)
-    problem_testdata = TabularIntgralField(null=True)
+    problem_task = DeferredTextField(null=True)
+    # kept as text; see _hoj_helpers.hoj_problem_judge_desc
+    problem_testdata = TextField(null=True)
     problem_title = CharField(null=True)
 
     class Meta:
@@ -104,9 +184,9 @@ class Submission(BaseModel):
     submission = AutoField(column_name='submission_id')
     contest = ForeignKeyField(Contest, column_name='contest_id', default=-1)
     problem = ForeignKeyField(Problem, column_name='problem_id', null=True)
-    submission_code = TextField(null=True)
+    submission_code = DeferredTextField(null=True)
     submission_date = DateTimeField(null=True)
-    submission_error = TextField(null=True)
+    submission_error = DeferredTextField(null=True)
     submission_len = IntegerField(default=0)
     submission_mem = IntegerField(default=0)
     submission_mode = IntegerField(default=0)
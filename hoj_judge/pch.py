@@ -0,0 +1,126 @@
+import contextlib
+import logging
+import os
+from os import path
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from . import cache
+
+'''
+Precompiled headers. A header is copied into a directory of its own next to
+its precompiled form, and that directory is put in front of the system
+include path, so the copy does not get the warnings of a user header.
+GCC picks the .gch up whenever it was built with compatible flags and falls
+back to the identical copy of the header otherwise, so the code being
+compiled cannot tell the difference.
+'''
+
+logger = logging.getLogger(__name__)
+
+# headers most submissions start with
+SUBMISSION_HEADERS = ['bits/stdc++.h']
+CHECKER_HEADERS = ['testlib.h']
+
+_located = {}
+def locateHeader(compiler, name, include_paths=()):
+    '''Find the file `#include <name>` resolves to, or None if there is none.'''
+    key = (compiler, name, tuple(include_paths))
+    if key not in _located:
+        cmd = [compiler, '-x', 'c++', '-E', '-H', '-o', '/dev/null', '-']
+        cmd += ['-I' + p for p in include_paths]
+        subp = subprocess.run(cmd,
+            input='#include <{}>\n'.format(name).encode(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        located = None
+        if subp.returncode == 0:
+            for ln in subp.stderr.decode(errors='replace').splitlines():
+                # the header itself is the first one at depth 1
+                if ln.startswith('. '):
+                    located = ln[2:]
+                    break
+        _located[key] = located
+    return _located[key]
+
+
+'''
+Get the directory containing `headers` precompiled with `cmd_tpl`, which is
+the command template the headers are going to be used with, building it if
+needed. Gives None if precompiled headers are disabled or fail to build. The
+directory is kept from being evicted until the context is left.
+'''
+@contextlib.contextmanager
+def prepare(cmd_tpl, headers, include_paths=(), store=None):
+    if store is None:
+        store = cache.getCache('pch')
+    if store is None:
+        yield None
+        return
+
+    compiler = shlex.split(cmd_tpl)[0]
+    sources = []
+    for name in headers:
+        located = locateHeader(compiler, name, include_paths)
+        if located is None:
+            logger.warning('Cannot locate header <%s> to precompile', name)
+            yield None
+            return
+        sources.append((name, located))
+
+    # any change of the compiler, the flags or the headers gets a new entry
+    key = cache.digest(
+        cmd_tpl, cache.compilerVersion(compiler), *include_paths,
+        *(name for name, _ in sources),
+        cache.fileDigest(*(src for _, src in sources)))
+
+    with store.lock(key):
+        built = store.get(key) is not None or _build(store, key, cmd_tpl, sources, include_paths)
+    if not built:
+        yield None
+        return
+
+    with store.lock(key, shared=True):
+        # it can be evicted in between the locks, if only from a full store
+        yield store.get(key)
+
+
+def _build(store, key, cmd_tpl, sources, include_paths):
+    logger.info('Precompiling headers %s for %r', [name for name, _ in sources], cmd_tpl)
+    files = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, src in sources:
+            hdr = path.join(tmpdir, name)
+            gch = hdr + '.gch'
+            os.makedirs(path.dirname(hdr), exist_ok=True)
+            shutil.copy2(src, hdr)
+            files[name] = hdr
+            files[name + '.gch'] = gch
+
+            cmd = cmd_tpl.format(
+                src='-x c++-header ' + shlex.quote(hdr),
+                output=shlex.quote(gch))
+            # quoted includes of the copy should still resolve the same
+            cmd = (shlex.split(cmd) + ['-iquote' + path.dirname(src)]
+                   + ['-I' + p for p in include_paths])
+
+            subp = subprocess.run(cmd,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if subp.returncode != 0:
+                logger.warning('Failed to precompile <%s>:\n%s', name,
+                    subp.stderr.decode(errors='replace'))
+                return False
+        store.put(key, files)
+    return True
+
+
+@contextlib.contextmanager
+def includeArgs(cmd_tpl, headers, include_paths=(), store=None):
+    '''Compiler arguments to make use of precompiled `headers`, if available,
+    for compiling within the context. Directories given with -I are searched
+    before these, so `include_paths` should be passed with -isystem after
+    them.'''
+    with prepare(cmd_tpl, headers, include_paths, store) as pch_dir:
+        yield [] if pch_dir is None else ['-isystem', pch_dir]
@@ -24,13 +24,19 @@ if _mswindows:
 else:
     from subprocess import (_PIPE_BUF, _PopenSelector)
 
+logger = logging.getLogger(__name__)
+
 # default pipe buffer size is 16 pages
 PIPE_BUFFER_SIZE = 4096 * 16
+# how much of the latest output a MemoryJournal keeps
+JOURNAL_CAPACITY = 1024 * 1024
 
 
 class _Popen(Popen):
     def __init__(self, *args, pipe_stdout=None, pipe_stderr=None, **kwargs):
         self.is_ole = [False] * 2
+        # set when a destination asks to stop the process, see _sync_once
+        self.aborted = False
         self._fd2dest = {}
         self._fd2limit = {}
         self._fd2length = {}
@@ -257,6 +263,14 @@ class _Popen(Popen):
 
         # FIXME: text mode or binary mode??
         dest.write(buf)
+
+        # a destination can tell that the rest of the output is of no use,
+        # e.g. a wrong answer. Stop the process and drain the pipe until it
+        # is closed; the destination discards whatever comes afterwards.
+        if not self.aborted and getattr(dest, 'aborted', False):
+            self.aborted = True
+            logger.debug('Output aborted by %r, terminating the process', dest)
+            self.terminate()
         return szr
 
 
@@ -270,7 +284,7 @@ def run_with_pipes(*popenargs, input=None, timeout=None, check=False,
     if input is not None:
         if 'stdin' in kwargs:
             raise ValueError('stdin and input arguments may not both be used.')
-        kwargs['stdin'] = PIPE
+        kwargs['stdin'] = subprocess.PIPE
 
     with _Popen(*popenargs, **kwargs) as process:
         try:
@@ -292,6 +306,47 @@ def run_with_pipes(*popenargs, input=None, timeout=None, check=False,
                             stderr), process.is_ole
 
 
+def copy_pipe(fd, dest, limit=None, buffer_size=PIPE_BUFFER_SIZE, timeout=None):
+    '''Copy from the pipe `fd` to `dest` until EOF, like the piped outputs of
+    _Popen do. Stops early if more than `limit` bytes come or `dest` aborts.
+    Returns (bytes copied, is_ole, aborted). Raises TimeoutExpired if EOF has
+    not come after `timeout` seconds.'''
+    if timeout is None:
+        return _copy_pipe(fd, dest, limit, buffer_size, os.read)
+
+    deadline = _time() + timeout
+    with _PopenSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+
+        def read(fd, sz):
+            remaining = deadline - _time()
+            if remaining <= 0 or not selector.select(remaining):
+                raise TimeoutExpired('copy_pipe', timeout)
+            return os.read(fd, sz)
+
+        return _copy_pipe(fd, dest, limit, buffer_size, read)
+
+
+def _copy_pipe(fd, dest, limit, buffer_size, read):
+    ntotal = 0
+    while True:
+        if limit is None or limit < 0:
+            sz = buffer_size
+        else:
+            sz = min(buffer_size, limit - ntotal)
+
+        buf = read(fd, sz) if sz > 0 else b''
+        if sz > 0 and not buf:  # EOF
+            return ntotal, False, False
+        if sz == 0:
+            return ntotal, bool(read(fd, 1)), False
+
+        ntotal += len(buf)
+        dest.write(buf)
+        if getattr(dest, 'aborted', False):
+            return ntotal, False, True
+
+
 class JournalPipe(object):
     def __init__(self, file):
         self.file = file
@@ -356,10 +411,127 @@ class JournalPipe(object):
         buf = self.file.read(self._length)
         return buf
 
+    def close(self):
+        # the file is closed by whoever opened it
+        pass
+
+
+class MemoryJournal(object):
+    '''A JournalPipe kept in memory. It holds the last `capacity` bytes written
+    in a ring buffer; once more has been written, the whole output goes to
+    `spill_path` as well if it is given, so that nothing is lost, and the
+    oldest output is dropped otherwise. Outputs are decoded only when they are
+    dumped, in text mode, so characters split across writes stay intact.'''
+    def __init__(self, capacity=JOURNAL_CAPACITY, spill_path=None, text_mode=True):
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.text_mode = text_mode
+        self.active = False
+        # str -> (offs, len), in bytes written since the journal was created
+        self.tag_map = {}
+
+        self._buf = bytearray()
+        self._total = 0
+        self._spill = None
+        self._active_tag = None
+        self._start = 0
+
+    def __repr__(self):
+        return '<MemoryJournal {}/{} bytes spill={}>'.format(
+            self._total, self.capacity, self._spill is not None)
+
+    def mark(self, tag):
+        if self._active_tag is not None:
+            raise Exception('Pipe is still in use. Call MemoryJournal.mark_end()'
+                            + ' first before starting another task.')
+        if tag is None:
+            raise ValueError('No tag is specified.')
+
+        self._active_tag = tag
+        self._start = self._total
+        self.active = True
+
+    def mark_end(self):
+        if not self._active_tag:
+            raise Exception('No active tag to mark_end.')
+        self.tag_map[self._active_tag] = (self._start, self._total - self._start)
+        self._active_tag = None
+        self.active = False
+
+    def write(self, buf):
+        data = memoryview(buf).cast('B')
+        n = len(data)
+        if self._spill is None and self.spill_path and self._total + n > self.capacity:
+            logger.debug('Spilling %r to %s', self, self.spill_path)
+            self._spill = open(self.spill_path, 'w+b')
+            # nothing has been dropped yet
+            self._spill.write(self._buf)
+        if self._spill is not None:
+            self._spill.write(data)
+
+        # only the last `capacity` bytes survive anyway
+        start = self._total + max(n - self.capacity, 0)
+        data = data[start - self._total:]
+        if len(self._buf) < self.capacity and start > len(self._buf):
+            self._buf.extend(bytes(self.capacity - len(self._buf)))
+        while data:
+            pos = start % self.capacity
+            chunk = data[:self.capacity - pos]
+            if pos == len(self._buf):
+                self._buf += chunk
+            else:
+                self._buf[pos:pos + len(chunk)] = chunk
+            start += len(chunk)
+            data = data[len(chunk):]
+        self._total += n
+        return n
+
+    def _slice(self, start, length):
+        oldest = self._total - len(self._buf)
+        if start < oldest:
+            if self._spill is not None:
+                self._spill.flush()
+                return os.pread(self._spill.fileno(), length, start)
+            logger.warning('%d bytes of the output have been dropped from %r', oldest - start, self)
+            length -= oldest - start
+            start = oldest
+        if length <= 0:
+            return b''
+
+        view = memoryview(self._buf)
+        i = start % self.capacity
+        j = (start + length - 1) % self.capacity + 1
+        if i < j:
+            return bytes(view[i:j])
+        return b''.join((view[i:], view[:j]))
+
+    def _decode(self, buf):
+        if self.text_mode:
+            # the start may have been dropped in the middle of a character
+            return buf.decode(errors='replace')
+        return buf
+
+    def dump(self, tag):
+        _conf = self.tag_map.get(tag, None)
+        if _conf is None:
+            raise ValueError('Undefined tag "{}"'.format(tag))
+        return self._decode(self._slice(*_conf))
+
+    def _read(self):
+        return self._decode(self._slice(self._start, self._total - self._start))
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
 
 class Journals(object):
+    '''Journals of the outputs of the tasks of a submission, one per file.
+    Files are wrapped in JournalPipes; MemoryJournals are used as they are.'''
     def __init__(self, *files):
-        self._journals = tuple(map(JournalPipe, files))
+        self._journals = tuple(f if isinstance(f, MemoryJournal) else JournalPipe(f)
+                               for f in files)
 
     def __getitem__(self, idx):
         return self._journals[idx]
@@ -381,6 +553,10 @@ class Journals(object):
         finally:
             self.mark_end()
 
+    def close(self):
+        for j in self._journals:
+            j.close()
+
 
 '''
 if __name__ == '__main__':
@@ -19,4 +19,4 @@ for subm in submissions:
 
     print(subm.problem.problem_testdata)
     print('desc')
-    print(hoj_to_judge_desc(subm.problem.problem_testdata))
+    print(hoj_problem_judge_desc(subm.problem))
@@ -0,0 +1,431 @@
+from collections import namedtuple
+import logging
+import math
+import os
+from os import path
+import re
+import resource
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+from . import cgroups
+from . import forkserver
+from . import helper
+from . import pipes
+from .utils import pformat
+
+'''
+Sandbox backends, which run the program of a submission for a test under the
+limits of the test and report how it went as a RunResult. The backend is
+chosen with `sandbox` in the [judge] section of config:
+
+- 'nsjail' runs every program in nsjail, started through the helper or sudo
+  (see helper.spawn), or in a fork server (see forkserver.py),
+- 'rlimit' runs the program directly as the user running the judge, limited
+  by rlimits and, if the judge may write to it, the memory cgroup of the
+  slot. It needs no root, but does not isolate the program in any way.
+
+Every backend has `slot`, `direct_output`, `run()` and `close()`.
+
+Outputs are copied from a pipe to their destination by the judge, which can
+then compare them while the program runs. With `direct_output`, the program
+writes to a file itself instead, and the output limit is enforced by the kernel as
+RLIMIT_FSIZE: programs going over it are killed by SIGXFSZ, which is taken as
+OLE. Programs ignoring SIGXFSZ get EFBIG instead, so the rlimit is set above
+the output limit, and an output longer than that is taken as OLE as well.
+'''
+
+logger = logging.getLogger(__name__)
+
+# arguments to nsjail, which is started by helper.spawn
+cmd_task_tpl = ('-C ../nsjail.cfg -D {cwd} '
+    '-t {time} --cgroup_mem_parent {cgroup} --cgroup_mem_max {mem} {cgroup_args} --log_fd {log_fd} '
+    '-- {exec}')
+
+# the wall-clock cap of a run in multiples of its time limit, when verdicts are
+# based on CPU time
+WALL_TIME_FACTOR = 3
+# stats that nsjail must have reported for a run
+REQUIRED_STATS = ('cgroup_memory_failcnt', 'cgroup_memory_max_usage', 'exit_normally', 'time')
+# without a memory cgroup, the address space of programs is capped at that
+# many times their memory limit, plus the slack, so that runaway programs
+# cannot take the box down
+ADDRESS_SPACE_FACTOR = 4
+ADDRESS_SPACE_SLACK = 256 * 1024 * 1024
+# like nsjail, deaths by signals are reported as 128 + the signal
+RETURNCODE_OLE = 128 + signal.SIGXFSZ
+
+
+def isDirectOle(returncode, dest, output_limit):
+    '''Whether a program that wrote to the file `dest` itself went over
+    `output_limit` bytes, which its RLIMIT_FSIZE must be above.'''
+    return returncode == RETURNCODE_OLE or os.fstat(dest.fileno()).st_size > output_limit
+
+
+'''
+How a run went. `time` is what the verdict is based on, either wall-clock or
+CPU time, and `wall_time` the wall-clock time, both in ms; `memory` is the
+peak in bytes. `stats` has the stats as nsjail reports them, as strings, and
+is what checkers get as the log_dict.
+'''
+RunResult = namedtuple('RunResult', [
+    'returncode', 'time', 'wall_time', 'memory',
+    'time_exceeded', 'memory_exceeded', 'output_exceeded', 'seccomp_violation',
+    'stats'
+])
+
+
+class SandboxError(Exception):
+    '''The sandbox has failed to run the program or to report on it. `stats`
+    has whatever it has reported.'''
+    def __init__(self, msg, stats=None):
+        super().__init__(msg)
+        self.stats = stats if stats is not None else {}
+
+
+class NsjailSandbox(object):
+    '''Run the program in nsjail, once per run or in a fork server with
+    `fork_server`. With `time_source` 'cgroup', times and memory peaks are
+    taken from the cgroup of the slot (see cgroups.CgroupMeter) and runs are
+    killed after `wall_time_factor` times their time limit.'''
+    def __init__(self, slot, exec_path, fork_server=False, time_source='wall',
+                 wall_time_factor=WALL_TIME_FACTOR, direct_output=False):
+        self.slot = slot
+        self.exec_path = exec_path
+        self.direct_output = direct_output
+        self.time_source = time_source
+        self.wall_time_factor = wall_time_factor
+        self._server = forkserver.ForkServer(slot, exec_path) if fork_server else None
+
+    def __repr__(self):
+        return '<NsjailSandbox {} server={!r}>'.format(self.slot.sandbox_path, self._server)
+
+    def run(self, f_in, dest, time_limit, mem_limit, output_limit):
+        '''Run the program once with `f_in` as its stdin, and its output
+        copied to `dest` up to `output_limit` bytes as pipes.copy_pipe does,
+        or written to the file `dest` by the program itself with
+        `direct_output`. `time_limit` is in ms and `mem_limit` in bytes.'''
+        direct = self.direct_output
+        log_file = open(self.slot.runlog_path, 'w+')
+        # the file is possibly not owned by the user executing task (via sudo),
+        # and latter writing will fail
+        os.chmod(self.slot.runlog_path, 0o666)
+        try:
+            # with CPU time from the cgroup, the wall clock only caps runs that idle
+            meter = None
+            wall_limit = time_limit
+            if self.time_source == 'cgroup':
+                meter = cgroups.CgroupMeter(self.slot.cgroup)
+                if meter.start():
+                    wall_limit = time_limit * self.wall_time_factor
+                else:
+                    meter = None
+            # nsjail takes whole seconds
+            wall_secs = math.ceil(wall_limit / 1000)
+
+            cgroup_args = []
+            cpu_secs = 0
+            if meter is not None:
+                cgroup_args = meter.nsjailArgs()
+                # also stop busy programs soon after they run out of CPU time; the
+                # extra second makes sure they are then over the limit
+                cpu_secs = math.ceil(time_limit / 1000) + 1
+            if direct:
+                # nsjail takes MB, and limits files to 1MB by default; the
+                # limit is above the output limit, see isDirectOle
+                cgroup_args = cgroup_args + [
+                    '--rlimit_fsize', str(math.ceil((output_limit + 1) / (1024 * 1024)))]
+
+            if self._server is not None:
+                logger.debug('Running subtask with %r', self._server)
+                returncode, is_ole = self._server.run(
+                    f_in, dest, output_limit, log_file, mem_limit, wall_secs, cpu_secs, cgroup_args,
+                    direct)
+            else:
+                returncode, is_ole = self._spawn(
+                    f_in, dest, output_limit, log_file, mem_limit, wall_secs, cpu_secs, cgroup_args,
+                    direct)
+            usage = meter.stop() if meter is not None else None
+            if direct:
+                is_ole = isDirectOle(returncode, dest, output_limit)
+
+            stats = self._readStats(log_file)
+        finally:
+            log_file.close()
+
+        return self._result(returncode, is_ole, stats, usage, time_limit, wall_secs)
+
+    def _spawn(self, f_in, dest, output_limit, log_file, mem, wall_secs, cpu_secs, cgroup_args,
+               direct=False):
+        if cpu_secs:
+            cgroup_args = cgroup_args + ['--rlimit_cpu', str(cpu_secs)]
+        cmd_task_str = cmd_task_tpl.format(
+            cwd=shlex.quote(path.realpath(self.slot.sandbox_path)),
+            cgroup=shlex.quote(self.slot.cgroup),
+            cgroup_args=' '.join(map(shlex.quote, cgroup_args)),
+            time=wall_secs,
+            mem=mem,
+            log_fd=log_file.fileno(),
+            exec=self.exec_path
+        )
+        cmd_task = shlex.split(cmd_task_str)
+
+        logger.debug('Starting subproc for subtask: %r', cmd_task)
+
+        if direct:
+            subp_task = helper.spawn(
+                cmd_task,
+                stdin=f_in,
+                stdout=dest,
+                stderr=subprocess.DEVNULL,
+                pass_fds=(log_file.fileno(),),
+                cpus=self.slot.task_cpus
+            )
+            return subp_task.wait(), False
+
+        fd_out, fd_out_w = os.pipe()
+        with open(fd_out, 'rb', buffering=0):
+            try:
+                subp_task = helper.spawn(
+                    cmd_task,
+                    stdin=f_in,
+                    stdout=fd_out_w,
+                    stderr=subprocess.DEVNULL,
+                    pass_fds=(log_file.fileno(),),
+                    cpus=self.slot.task_cpus
+                )
+            finally:
+                os.close(fd_out_w)
+            _, is_ole, aborted = pipes.copy_pipe(fd_out, dest, output_limit)
+            if aborted:
+                logger.debug('Output aborted by %r, terminating the process', dest)
+                subp_task.terminate()
+        return subp_task.wait(), is_ole
+
+    def _readStats(self, log_file):
+        '''Parse the output and filter out the STATs key-value pairs.'''
+        # TODO: interrupt if the log file is empty. the worker probably fails to start up
+        log_file.seek(0)
+        stats = {}
+        for ln in log_file:
+            mat = re.match(r'\[S\]\[\d+?\] __STAT__:0 (?:\d+?:)?([\w]+)\s+=\s+(.*)', ln)
+            if mat is None:
+                # TODO: triage the message to separate file
+                logger.debug('SANDBOX >>> %s', ln[:-1])
+                continue
+            stats[mat.group(1)] = mat.group(2)
+
+        logger.debug('captured stat dict:\n%s', pformat(stats))
+        return stats
+
+    def _result(self, returncode, is_ole, stats, usage, time_limit, wall_secs):
+        for k in REQUIRED_STATS:
+            if k not in stats:
+                raise SandboxError('Cannot find key "{}" from log, which is mandatory'.format(k), stats)
+
+        wall_time = int(stats['time'])
+        if usage is not None:
+            # report what the verdict is based on
+            cpu_time, peak = usage
+            stats['wall_time'] = stats['time']
+            stats['time'] = str(cpu_time)
+            if peak is not None:
+                stats['cgroup_memory_max_usage'] = str(peak)
+            logger.debug('CPU time %sms, memory peak %s bytes from cgroup', cpu_time, peak)
+
+        time_used = int(stats['time'])
+        exited_normally = (stats['exit_normally'] != 'false')
+        if usage is not None:
+            time_exceeded = (time_used > time_limit or
+                (not exited_normally and wall_time >= wall_secs * 1000))
+        else:
+            time_exceeded = (not exited_normally and time_used >= time_limit)
+
+        return RunResult(
+            returncode=returncode,
+            time=time_used,
+            wall_time=wall_time,
+            memory=int(stats['cgroup_memory_max_usage']),
+            time_exceeded=time_exceeded,
+            memory_exceeded=(stats['cgroup_memory_failcnt'] != '0'),
+            # looks like nsjail ignores SIGPIPE and let children continue to run
+            # until TLE, because of the pid-namespace :(
+            output_exceeded=is_ole,
+            seccomp_violation=(stats.get('seccomp_violation', '') != 'false'),
+            stats=stats,
+        )
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+
+class RlimitSandbox(object):
+    '''Run the program directly as the user running the judge, for boxes
+    without root or nsjail, such as those of developers and benchmarks. There
+    is no isolation and no syscall filter; run only trusted programs with it.
+
+    Times are CPU times from the rusage of the program, which is limited with
+    RLIMIT_CPU and killed after `wall_time_factor` times its time limit.
+    Memory is limited by the cgroup of the slot if the judge may write to it
+    (see cgroups.MemoryLimit); otherwise a program is over its limit if its
+    resident set has peaked above it. Whatever the program forks is killed
+    once it exits. The fork server does not apply.'''
+    def __init__(self, slot, exec_path, wall_time_factor=WALL_TIME_FACTOR, direct_output=False,
+                 **unused):
+        self.slot = slot
+        self.exec_path = exec_path
+        self.direct_output = direct_output
+        self.wall_time_factor = wall_time_factor
+        self._limit = cgroups.MemoryLimit(slot.cgroup)
+        if not self._limit.available():
+            logger.debug('Cannot write to %r, limiting memory with rlimits only', self._limit)
+            self._limit = None
+
+    def __repr__(self):
+        return '<RlimitSandbox {} cgroup={!r}>'.format(self.slot.sandbox_path, self._limit)
+
+    def run(self, f_in, dest, time_limit, mem_limit, output_limit):
+        '''See NsjailSandbox.run().'''
+        direct = self.direct_output
+        cmd = [path.realpath(path.join(self.slot.sandbox_path, self.exec_path))]
+        cpu_secs = math.ceil(time_limit / 1000) + 1
+        limit = self._limit if self._limit is not None and self._limit.start(mem_limit) else None
+        cpus = self.slot.task_cpus
+
+        def preexec():
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_secs, cpu_secs))
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+            if limit is not None:
+                limit.join()
+            else:
+                cap = mem_limit * ADDRESS_SPACE_FACTOR + ADDRESS_SPACE_SLACK
+                resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+            if direct:
+                # see isDirectOle
+                resource.setrlimit(resource.RLIMIT_FSIZE, (output_limit + 1, output_limit + 1))
+
+        logger.debug('Starting subproc for subtask: %r', cmd)
+
+        timed_out = threading.Event()
+        time_start = time.perf_counter()
+        fd_out = fd_out_w = None
+        if not direct:
+            fd_out, fd_out_w = os.pipe()
+        try:
+            subp_task = subprocess.Popen(
+                cmd,
+                cwd=self.slot.sandbox_path,
+                stdin=f_in,
+                stdout=dest if direct else fd_out_w,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=preexec,
+                # so that whatever it forks is killed along with it
+                start_new_session=True
+            )
+        except:
+            if fd_out is not None:
+                os.close(fd_out)
+            if limit is not None:
+                limit.close()
+            raise
+        finally:
+            if fd_out_w is not None:
+                os.close(fd_out_w)
+
+        def killGroup():
+            try:
+                os.killpg(subp_task.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        def kill():
+            timed_out.set()
+            killGroup()
+
+        def reap():
+            # wait without reaping, so that no kill can reach another process
+            # that has taken the pid, then kill what the program has left
+            # behind holding its stdout
+            os.waitid(os.P_PID, subp_task.pid, os.WEXITED | os.WNOWAIT)
+            killGroup()
+
+        timer = threading.Timer(time_limit * self.wall_time_factor / 1000, kill)
+        timer.start()
+        reaper = threading.Thread(target=reap, daemon=True)
+        reaper.start()
+        is_ole = False
+        if fd_out is not None:
+            with open(fd_out, 'rb', buffering=0):
+                _, is_ole, aborted = pipes.copy_pipe(fd_out, dest, output_limit)
+                if aborted or is_ole:
+                    logger.debug('Output aborted or over the limit, killing the process')
+                    killGroup()
+
+        reaper.join()
+        wall_time = int((time.perf_counter() - time_start) * 1000)
+        timer.cancel()
+        timer.join()
+        _, status, rusage = os.wait4(subp_task.pid, 0)
+        subp_task.returncode = os.waitstatus_to_exitcode(status)
+
+        # like nsjail, report deaths by signals as 128 + the signal
+        returncode = subp_task.returncode
+        if returncode < 0:
+            returncode = 128 - returncode
+        if direct:
+            is_ole = isDirectOle(returncode, dest, output_limit)
+        cpu_time = int((rusage.ru_utime + rusage.ru_stime) * 1000)
+
+        usage = limit.stop() if limit is not None else None
+        if usage is not None:
+            peak, memory_exceeded = usage
+        else:
+            peak = rusage.ru_maxrss * 1024
+            memory_exceeded = (peak > mem_limit)
+
+        exited_normally = not (timed_out.is_set() or subp_task.returncode < 0)
+        stats = {
+            'time': str(cpu_time),
+            'wall_time': str(wall_time),
+            'cgroup_memory_max_usage': str(peak),
+            'cgroup_memory_failcnt': '1' if memory_exceeded else '0',
+            'exit_normally': 'true' if exited_normally else 'false',
+            'exit_status': str(returncode),
+        }
+        logger.debug('captured stat dict:\n%s', pformat(stats))
+
+        return RunResult(
+            returncode=returncode,
+            time=cpu_time,
+            wall_time=wall_time,
+            memory=peak,
+            time_exceeded=(cpu_time > time_limit or timed_out.is_set()),
+            memory_exceeded=memory_exceeded,
+            output_exceeded=is_ole,
+            seccomp_violation=False,
+            stats=stats,
+        )
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    'nsjail': NsjailSandbox,
+    'rlimit': RlimitSandbox,
+}
+
+
+def create(name, slot, exec_path, **options):
+    '''Create the sandbox backend `name` to run `exec_path` in the sandbox of
+    `slot`. `options` are passed to the backend.'''
+    if name not in BACKENDS:
+        raise ValueError('Unknown sandbox backend {!r}, expecting one of {}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name](slot, exec_path, **options)
@@ -0,0 +1,304 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+import hoj_judge.models_hoj as m
+from . import metrics
+from ._hoj_helpers import HojVerdict
+from .slots import DEFAULT_SLOT
+
+'''
+A resident judge worker. Pending submissions are claimed one at a time so
+that several workers may share the same HOJ DB without judging a submission
+twice, and the process, DB connection and caches stay warm in between.
+Under load, the results of several submissions can be written with one
+UPDATE; their claims are held until then, and taken again if the connection
+holding them is lost, dropping the results of those claimed by another worker
+in the meantime. Submissions that cannot be judged
+are retried a few times and then given up as SERR.
+Running several slots forks one worker per slot, each with its own connection.
+'''
+
+logger = logging.getLogger(__name__)
+
+# emitter/emitter.c reads the pid from here to wake the worker up
+PIDFILE_PATH = '/tmp/judge.pid'
+POLL_INTERVAL = 5
+RETRY_INTERVAL = 60
+MAX_ATTEMPTS = 3
+FETCH_LIMIT = 16
+BATCH_SIZE = 1
+BATCH_INTERVAL = 2
+
+
+class JudgeDaemon(object):
+    def __init__(self, judge_func, update_func,
+                 slot=DEFAULT_SLOT,
+                 poll_interval=POLL_INTERVAL,
+                 retry_interval=RETRY_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS,
+                 batch_size=BATCH_SIZE,
+                 batch_interval=BATCH_INTERVAL,
+                 pidfile=PIDFILE_PATH):
+        self.judge_func = judge_func
+        self.update_func = update_func
+        self.slot = slot
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.pidfile = pidfile
+
+        self._wakeup = threading.Event()
+        self._stopping = False
+        # submission id -> time after which it may be retried
+        self._backoff = {}
+        # submission id -> failed attempts to judge it
+        self._failures = {}
+        # submission id -> results waiting for a batched write
+        self._unwritten = {}
+        self._unwritten_since = 0
+        # whether the claims of the results above went with a lost connection
+        self._claims_lost = False
+        # m.reconnect_count() when the last claim was taken
+        self._reconnects = 0
+
+    def wakeup(self, *_):
+        self._wakeup.set()
+
+    def stop(self, *_):
+        logger.info('Stopping after the current submission...')
+        self._stopping = True
+        self._wakeup.set()
+
+    def run(self):
+        signal.signal(signal.SIGUSR1, self.wakeup)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        if self.pidfile:
+            with open(self.pidfile, 'w') as f:
+                f.write(str(os.getpid()))
+
+        self.slot.pin()
+        logger.info('Judge daemon started with pid %d in %r', os.getpid(), self.slot)
+        with metrics.context(slot=self.slot.index):
+            self._run()
+        logger.info('Judge daemon stopped')
+
+    def _run(self):
+        try:
+            while not self._stopping:
+                self._wakeup.clear()
+                try:
+                    judged = self.runOnce()
+                except m.OperationalError:
+                    logger.exception('Lost connection to the database, reconnecting later:')
+                    if not m.DATABASE.is_closed():
+                        m.DATABASE.close()
+                    self._claims_lost = bool(self._unwritten)
+                    judged = False
+
+                if not judged:
+                    self._wakeup.wait(self.poll_interval)
+        finally:
+            try:
+                self.flush()
+            except m.OperationalError:
+                logger.exception('Failed to write the results of submissions %s:',
+                    list(self._unwritten))
+            if not m.DATABASE.is_closed():
+                m.DATABASE.close()
+            if self.pidfile:
+                try:
+                    os.remove(self.pidfile)
+                except FileNotFoundError:
+                    pass
+
+    def runOnce(self):
+        '''Judge at most one pending submission. Returns whether one is judged.'''
+        m.DATABASE.connect(reuse_if_open=True)
+
+        judged = self.judgeOne()
+        if (not judged or len(self._unwritten) >= self.batch_size
+                or time.monotonic() - self._unwritten_since >= self.batch_interval):
+            self.flush()
+        return judged
+
+    def judgeOne(self):
+        now = time.monotonic()
+        self._backoff = {id: t for id, t in self._backoff.items() if t > now}
+        for id in m.pending_submissions(FETCH_LIMIT, set(self._backoff) | set(self._unwritten)):
+            if not m.claim_submission(id):
+                continue
+            try:
+                # the locks are counted, so the lost claims are taken again
+                # before this one joins them
+                self.checkReconnects()
+                if self._claims_lost:
+                    self.reclaim()
+                with metrics.context(submission=id):
+                    # another worker may have finished it before we got the claim
+                    with metrics.span('fetch'):
+                        try:
+                            submission = m.judge_submission(id)
+                        except m.DoesNotExist:
+                            logger.warning('Submission %d has been deleted', id)
+                            continue
+                    if submission.submission_status != 0:
+                        continue
+                    metrics.tag(problem=submission.problem_id)
+                    self.judgeClaimed(submission)
+                    metrics.export()
+            finally:
+                # results waiting to be written keep their claim
+                if id not in self._unwritten:
+                    m.release_submission(id)
+            return True
+        return False
+
+    def flush(self):
+        '''Write the results waiting for a batched write, and release their
+        claims. They are kept for the next try if the write fails.'''
+        self.checkReconnects()
+        if self._claims_lost:
+            self.reclaim()
+        if not self._unwritten:
+            return
+        with metrics.span('update', batch=len(self._unwritten)):
+            m.update_submissions(self._unwritten)
+        metrics.export()
+        ids, self._unwritten = list(self._unwritten), {}
+        for id in ids:
+            m.release_submission(id)
+        logger.info('Results of submissions %s written', ids)
+
+    def checkReconnects(self):
+        '''Note whether the database has replaced its connection since the
+        last claim, which has taken the claims of the results waiting along.'''
+        reconnects = m.reconnect_count()
+        if reconnects == self._reconnects:
+            return
+        self._reconnects = reconnects
+        if self._unwritten and not self._claims_lost:
+            logger.warning('Lost the claims of submissions %s with the connection',
+                list(self._unwritten))
+            self._claims_lost = True
+
+    def reclaim(self):
+        '''Claim the submissions waiting to be written again, after their
+        claims were lost with the connection. Those claimed or finished by
+        another worker meanwhile are dropped.'''
+        for id in list(self._unwritten):
+            if not m.claim_submission(id):
+                logger.warning('Submission %d has been claimed by another worker, '
+                    'dropping its results', id)
+                del self._unwritten[id]
+        statuses = m.submission_statuses(self._unwritten)
+        for id in list(self._unwritten):
+            if statuses.get(id) != 0:
+                logger.warning('Submission %d has been judged by another worker, '
+                    'dropping its results', id)
+                del self._unwritten[id]
+                m.release_submission(id)
+        self._claims_lost = False
+
+    def judgeClaimed(self, submission):
+        id = submission.submission
+        logger.info('Start judging submission of ID %d...', id)
+        try:
+            ret = self.judge_func(submission, self.slot)
+        except Exception:
+            logger.exception('Unexpected error when judging submission %d:', id)
+            ret = None
+
+        if ret is None:
+            attempts = self._failures[id] = self._failures.get(id, 0) + 1
+            if attempts < self.max_attempts:
+                logger.error('Failed to judge submission %d, retrying after %ds',
+                    id, self.retry_interval)
+                self._backoff[id] = time.monotonic() + self.retry_interval
+                return
+            logger.error('Failed to judge submission %d %d times, giving up', id, attempts)
+            ret = {
+                'verdict': HojVerdict.SERR,
+                'update': {
+                    'submission_status': HojVerdict.SERR.value,
+                    'submission_score': 0,
+                    'submission_error': 'The submission could not be judged.',
+                }
+            }
+
+        self._backoff.pop(id, None)
+        self._failures.pop(id, None)
+        if self.batch_size > 1:
+            if not self._unwritten:
+                self._unwritten_since = time.monotonic()
+            self._unwritten[id] = ret['update']
+        else:
+            with metrics.span('update'):
+                self.update_func(submission, ret['update'])
+        logger.info('Submission %d judged with verdict %r', id, ret['verdict'])
+
+
+'''
+Fork one worker for each of `daemons` and supervise them. Signals are relayed
+to the workers, and workers that die unexpectedly are restarted.
+'''
+def superviseDaemons(daemons, pidfile=PIDFILE_PATH):
+    children = {}
+    stopping = False
+
+    def spawn(daemon):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                daemon.run()
+                code = 0
+            except Exception:
+                logger.exception('Worker of %r crashed:', daemon.slot)
+            finally:
+                os._exit(code)
+        children[pid] = daemon
+
+    def relay(signum, _):
+        nonlocal stopping
+        if signum != signal.SIGUSR1:
+            stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for daemon in daemons:
+        spawn(daemon)
+
+    for signum in (signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, relay)
+
+    if pidfile:
+        with open(pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+
+    try:
+        while children:
+            pid, status = os.wait()
+            daemon = children.pop(pid, None)
+            if daemon is None:
+                continue
+            if not stopping:
+                logger.error('Worker of %r exited unexpectedly with status %d, restarting',
+                    daemon.slot, status)
+                time.sleep(1)
+                spawn(daemon)
+    finally:
+        if pidfile:
+            try:
+                os.remove(pidfile)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,112 @@
+import copy
+import os
+from os import path
+import shutil
+
+'''
+Judge slots. Every slot owns its scratch paths and memory cgroup so that
+several submissions can be judged on the same host at once. Slot 0 keeps the
+historical single-judge paths; other slots live under their own directory on
+the tmpfs.
+'''
+
+SLOT_ROOT_PATH = '/run/shm'
+CGROUP_NAME = 'sandbox'
+
+
+class JudgeSlot(object):
+    def __init__(self, index=0, cpus=None, root=SLOT_ROOT_PATH):
+        self.index = index
+        self.cpus = cpus
+
+        if index == 0:
+            self.suffix = ''
+            self.work_path = root
+            self.sandbox_path = path.join(root, 'judge')
+            self.userout_path = '/tmp/test'
+            self.checker_src_path = '/tmp/special.cpp'
+            self.log_stdout_path = '/tmp/judge.stdout.log'
+            self.log_stderr_path = '/tmp/judge.stderr.log'
+        else:
+            self.suffix = '-{}'.format(index)
+            self.work_path = path.join(root, 'slot{}'.format(self.suffix))
+            self.sandbox_path = path.join(self.work_path, 'judge')
+            self.userout_path = path.join(self.work_path, 'test')
+            self.checker_src_path = path.join(self.work_path, 'special.cpp')
+            self.log_stdout_path = path.join(self.work_path, 'judge.stdout.log')
+            self.log_stderr_path = path.join(self.work_path, 'judge.stderr.log')
+
+        self.runlog_path = path.join(self.work_path, 'sandbox.log')
+        # where programs write their output themselves with direct_output,
+        # which is on the tmpfs for every slot
+        self.output_path = path.join(self.work_path, 'output')
+        self.complog_path = path.join(self.work_path, 'compile.log')
+        # special judges are run inside work_path as well
+        self.checker_path = path.join(self.work_path, 'checker')
+        self.cgroup = CGROUP_NAME + self.suffix
+        # CPUs to pin sandboxed runs to; only set for lanes, since slot
+        # workers pin themselves (and thus their children) as a whole
+        self.task_cpus = None
+
+    def __repr__(self):
+        return ('<JudgeSlot #{} sandbox={} cgroup={} cpus={}>'
+            .format(self.index, self.sandbox_path, self.cgroup, self.cpus))
+
+    def prepare(self):
+        os.makedirs(self.sandbox_path, exist_ok=True)
+
+    def pin(self):
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+
+    def lanes(self, num_lanes):
+        '''Split the slot into lanes to run tests of a submission in parallel.
+        Each lane has its own sandbox dir, run log, output path and cgroup,
+        while the checker is still shared.'''
+        cpus = sorted(self.cpus or os.sched_getaffinity(0))
+        lanes = []
+        for j in range(num_lanes):
+            lane = copy.copy(self)
+            lane.work_path = path.join(self.work_path, 'lane-{}'.format(j))
+            lane.sandbox_path = path.join(lane.work_path, 'judge')
+            lane.runlog_path = path.join(lane.work_path, 'sandbox.log')
+            lane.userout_path = path.join(lane.work_path, 'test')
+            lane.output_path = path.join(lane.work_path, 'output')
+            # nested in the slot's cgroup, so that usage is measured per lane
+            lane.cgroup = '{}/lane-{}'.format(self.cgroup, j)
+            lane.task_cpus = {cpus[j % len(cpus)]}
+            lanes.append(lane)
+        return lanes
+
+    def adopt(self, slot, *files):
+        '''Make files in the sandbox of `slot` available in this one.'''
+        self.prepare()
+        for name in files:
+            src = path.join(slot.sandbox_path, name)
+            dest = path.join(self.sandbox_path, name)
+            if path.lexists(dest):
+                os.remove(dest)
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copy2(src, dest)
+
+
+'''
+Create `num_slots` slots and spread the CPUs this process may run on among
+them, `cpus_per_slot` each. CPUs are reused in a round-robin manner if there
+are not enough of them; 0 disables pinning.
+'''
+def makeSlots(num_slots, cpus_per_slot=1, root=SLOT_ROOT_PATH):
+    available = sorted(os.sched_getaffinity(0))
+    slots = []
+    for i in range(num_slots):
+        cpus = None
+        if cpus_per_slot > 0:
+            cpus = {available[(i * cpus_per_slot + j) % len(available)]
+                    for j in range(cpus_per_slot)}
+        slots.append(JudgeSlot(i, cpus, root))
+    return slots
+
+
+DEFAULT_SLOT = JudgeSlot(0)
@@ -0,0 +1,209 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from os import path
+import shutil
+import tempfile
+
+from . import cache
+from . import diff
+
+'''
+Test data of problems, kept in testdata/<problem id>/<label>.in|out.
+
+Every problem directory has a manifest with the size, mtime and SHA-256 of
+its files, and the fingerprints of the expected outputs (see
+diff.fingerprintFile), built by `hoj_judge testdata index` and brought up to date by
+comparing sizes and mtimes whenever the problem is judged, so that only
+changed files are hashed again. Checking test data is then a lookup, and the
+hashes identify the content without reading it.
+
+Since the same problems are judged over and over during a contest, their test
+data is also staged into a store on tmpfs on first use and read from memory
+afterwards. Entries are keyed by the hashes in the manifest, so that changed
+test data is staged again, and the old copy is evicted in time, though never
+while a judge is reading from it.
+'''
+
+logger = logging.getLogger(__name__)
+
+TESTDATA_PATH = path.relpath(path.join(__package__, '..', 'testdata'))
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_VERSION = 2
+# next to the sandbox of slot 0
+STAGE_ROOT_PATH = '/run/shm/hoj-testdata'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def problemPath(problem_id, root=TESTDATA_PATH):
+    return path.join(root, str(problem_id))
+
+
+def sha256File(p):
+    h = hashlib.sha256()
+    with open(p, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    '''The files of a problem directory: {name: {'size', 'mtime_ns', 'sha256'}},
+    with 'fingerprint' as well for .out files. Hidden files, such as the
+    manifest itself, are left out.'''
+    def __init__(self, problem_path, files=None):
+        self.path = problem_path
+        self.files = files or {}
+
+    def __repr__(self):
+        return '<Manifest {} files={}>'.format(self.path, len(self.files))
+
+    @classmethod
+    def load(cls, problem_path):
+        try:
+            with open(path.join(problem_path, MANIFEST_FILENAME)) as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                return cls(problem_path, data['files'])
+            logger.info('Manifest of %s is outdated, rebuilding it', problem_path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            logger.warning('Broken manifest in %s, rebuilding it', problem_path, exc_info=True)
+        return cls(problem_path)
+
+    def save(self):
+        '''Write the manifest into the problem directory. Returns False if it
+        cannot be written there, e.g. for lack of permission.'''
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.manifest-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'version': MANIFEST_VERSION, 'files': self.files}, f,
+                              indent=1, sort_keys=True)
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, path.join(self.path, MANIFEST_FILENAME))
+            except:
+                os.remove(tmp)
+                raise
+        except OSError:
+            logger.warning('Cannot save the manifest of %s', self.path, exc_info=True)
+            return False
+        return True
+
+    def refresh(self, force=False):
+        '''Bring the manifest up to date with the directory, hashing the files
+        whose size or mtime has changed, or all files if `force`. Returns
+        whether anything has changed.'''
+        files = {}
+        try:
+            entries = [e for e in os.scandir(self.path)
+                       if not e.name.startswith('.') and e.is_file()]
+        except FileNotFoundError:
+            entries = []
+
+        for ent in entries:
+            st = ent.stat()
+            old = self.files.get(ent.name)
+            if (not force and old is not None and old['size'] == st.st_size
+                    and old['mtime_ns'] == st.st_mtime_ns):
+                files[ent.name] = old
+                continue
+            logger.debug('Hashing %s', ent.path)
+            files[ent.name] = {
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'sha256': sha256File(ent.path),
+            }
+            if ent.name.endswith('.out'):
+                with open(ent.path, 'rb') as f:
+                    files[ent.name]['fingerprint'] = diff.fingerprintFile(f)
+
+        changed = (files != self.files)
+        self.files = files
+        return changed
+
+    def has(self, name):
+        return name in self.files
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def key(self):
+        '''Identifies the content of the directory.'''
+        return cache.digest(*('{} {}'.format(name, self.files[name]['sha256'])
+                              for name in sorted(self.files)))
+
+
+# resident judges keep them in memory, in case they cannot be saved
+_manifests = {}
+def manifest(problem_id, root=TESTDATA_PATH, force=False):
+    '''Get the up-to-date manifest of a problem, saving it if it has changed.'''
+    problem_path = problemPath(problem_id, root)
+    man = _manifests.get(problem_path)
+    if man is None:
+        man = _manifests[problem_path] = Manifest.load(problem_path)
+    if man.refresh(force) and man.files:
+        logger.info('Updating the manifest of problem %s', problem_id)
+        man.save()
+    return man
+
+
+def _stage(store, key, problem_id, man):
+    '''Copy the test data into the store unless it is there. Returns whether
+    it is there.'''
+    with store.lock(key):
+        entry = store.get(key)
+        if entry is not None:
+            logger.debug('Test data cache hit: %s', entry)
+            return True
+
+        if sum(f['size'] for f in man.files.values()) > store.max_size:
+            logger.warning('Test data of problem %s does not fit in the store', problem_id)
+            return False
+
+        logger.info('Staging test data of problem %s', problem_id)
+        files = {name: path.join(man.path, name) for name in man.files}
+        entry = store.put(key, files, {'problem': problem_id})
+        if man.refresh():
+            # changed while being copied; the next judge stages it again
+            logger.warning('Test data of problem %s has changed while being staged', problem_id)
+            shutil.rmtree(entry, ignore_errors=True)
+            man.save()
+            return False
+        return True
+
+
+@contextlib.contextmanager
+def stage(problem_id, man):
+    '''Get the directory to read the test data of the problem from, which is
+    the staged copy if the store is enabled. `man` is its manifest. The copy
+    is kept from being evicted until the context is left.'''
+    store = cache.getCache('testdata', STAGE_ROOT_PATH)
+    if store is None or not man.files:
+        yield man.path
+        return
+
+    key = man.key()
+    try:
+        staged = _stage(store, key, problem_id, man)
+    except OSError:
+        logger.warning('Cannot stage test data of problem %s, reading it from %s',
+                       problem_id, man.path, exc_info=True)
+        staged = False
+    if not staged:
+        yield man.path
+        return
+
+    with store.lock(key, shared=True):
+        # it can be evicted in between the locks, if only from a full store
+        entry = store.get(key)
+        yield man.path if entry is None else entry
+
+
+def problemIds(root=TESTDATA_PATH):
+    '''The problems that have test data under `root`.'''
+    return sorted((e.name for e in os.scandir(root) if e.is_dir() and not e.name.startswith('.')),
+                  key=lambda name: (not name.isdigit(), int(name) if name.isdigit() else 0, name))
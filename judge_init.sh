@@ -4,10 +4,35 @@
 CG_USER=nobody
 CG_GROUP=nogroup
 CG_NAME=sandbox
+# cpu and cpuacct are only used with time_source = 'cgroup' in the [judge] section of config
+CG_CONTROLLERS=memory,cpu,cpuacct
 JUDGE_TMPFS_PATH=/run/shm/judge
+# number of judge slots, should match `slots` in the [serve] section of config
+NUM_SLOTS=${1:-1}
+# number of lanes per slot, should be at least the largest `parallel_tests` in config
+NUM_LANES=${2:-0}
 
-echo "Creating memory control group '${CG_NAME}' for ${CG_USER}:${CG_GROUP}..."
-sudo cgcreate -t ${CG_USER}:${CG_GROUP} -a ${CG_USER}:${CG_GROUP} -g memory:${CG_NAME}
+createGroup() {
+    sudo cgcreate -t ${CG_USER}:${CG_GROUP} -a ${CG_USER}:${CG_GROUP} -g ${CG_CONTROLLERS}:$1
+    for (( j = 0; j < NUM_LANES; j++ )); do
+        sudo cgcreate -t ${CG_USER}:${CG_GROUP} -a ${CG_USER}:${CG_GROUP} -g ${CG_CONTROLLERS}:$1/lane-${j}
+    done
+}
+
+echo "Creating control group '${CG_NAME}' for ${CG_USER}:${CG_GROUP}..."
+createGroup ${CG_NAME}
+
+echo "Building the fork server..."
+ROOT_PATH="$(dirname "$0")"
+"${ROOT_PATH}/scripts/gen-forkserver-cfg.sh" || exit 1
+gcc -O2 -Wall -o "${ROOT_PATH}/runner/runner" "${ROOT_PATH}/runner/runner.c"
 
 echo "Creating tmpfs '${JUDGE_TMPFS_PATH}'..."
 mkdir -p ${JUDGE_TMPFS_PATH}
+
+# slot 0 uses the paths above; the others get their own cgroup and directory
+for (( i = 1; i < NUM_SLOTS; i++ )); do
+    echo "Creating control group '${CG_NAME}-${i}' and tmpfs for slot ${i}..."
+    createGroup ${CG_NAME}-${i}
+    mkdir -p "$(dirname ${JUDGE_TMPFS_PATH})/slot-${i}/judge"
+done
@@ -0,0 +1,21 @@
+/*
+ * Syscalls the runner needs on top of the policy of nsjail.cfg, one X(name)
+ * per line. The jail of the fork server allows them (nsjail.forkserver.cfg is
+ * generated from this list by scripts/gen-forkserver-cfg.sh), and the runner
+ * denies them again to the programs it runs.
+ */
+X(alarm)
+X(setitimer)
+X(kill)
+X(dup2)
+X(dup3)
+X(recvmsg)
+X(sendmsg)
+X(rt_sigprocmask)
+X(clock_gettime)
+X(ppoll)
+X(setrlimit)
+X(prlimit64)
+X(prctl)
+X(seccomp)
+X(setpgid)
@@ -0,0 +1,259 @@
+/*
+ * Fork server that runs a program many times inside a single nsjail instance,
+ * saving sudo and the set-up of the jail for every test.
+ *
+ * Usage: runner <socket fd> <program> [args...]
+ *
+ * For each run the judge sends "<wall secs> <cpu secs>\n" over the socket
+ * with the stdin and stdout of the program and the read end of a pipe
+ * attached as SCM_RIGHTS. The runner forks, runs the program and answers with
+ * the __STAT__ lines nsjail would log, followed by an empty line. The program
+ * is killed if anything is written to the pipe or it is closed before. The
+ * runner exits once the socket is closed.
+ *
+ * Each program runs in a process group of its own, which it cannot leave, and
+ * the whole group is killed and reaped once the program exits, so that no
+ * process it forked outlives the run and keeps its stdout open.
+ *
+ * The jail is started with the policy of nsjail.cfg plus the syscalls listed
+ * in extra_syscalls.h (see scripts/gen-forkserver-cfg.sh). The program gets a
+ * filter denying those on top, so that it ends up with the same policy as
+ * usual. Only x86_64 is supported; the filter kills anything else.
+ */
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stddef.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <linux/audit.h>
+#include <linux/filter.h>
+#include <linux/seccomp.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/socket.h>
+#include <sys/syscall.h>
+#include <sys/wait.h>
+
+/* the syscall numbers below are those of x86_64 */
+#if !defined(__x86_64__) || defined(__ILP32__)
+#error "the runner only supports x86_64"
+#endif
+
+static const int EXTRA_SYSCALLS[] = {
+#define X(name) SYS_##name,
+#include "extra_syscalls.h"
+#undef X
+};
+#define NUM_EXTRA_SYSCALLS (sizeof(EXTRA_SYSCALLS) / sizeof(EXTRA_SYSCALLS[0]))
+
+static volatile sig_atomic_t timed_out = 0;
+/* the mask while waiting for a program, letting SIGALRM and SIGCHLD in */
+static sigset_t wait_mask;
+
+static void onAlarm(int sig) {
+    (void)sig;
+    timed_out = 1;
+}
+
+static void onChild(int sig) {
+    (void)sig;
+}
+
+static int denyExtraSyscalls(void) {
+    struct sock_filter filter[6 + 2 * NUM_EXTRA_SYSCALLS + 1];
+    size_t k = 0;
+
+    /* other ABIs number the syscalls differently, so kill them altogether */
+    filter[k++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, arch));
+    filter[k++] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, AUDIT_ARCH_X86_64, 1, 0);
+    filter[k++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL);
+    filter[k++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, nr));
+    /* x32 syscalls share the arch of x86_64 */
+    filter[k++] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JGE | BPF_K, __X32_SYSCALL_BIT, 0, 1);
+    filter[k++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL);
+    for (size_t i = 0; i < NUM_EXTRA_SYSCALLS; i++) {
+        filter[k++] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, EXTRA_SYSCALLS[i], 0, 1);
+        filter[k++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL);
+    }
+    filter[k++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
+
+    struct sock_fprog prog = { .len = (unsigned short)k, .filter = filter };
+    /* already set by nsjail, but required for the filter anyway */
+    if (prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) != 0)
+        return -1;
+    return prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, &prog);
+}
+
+/* receive a request with exactly three fds; returns its length, 0 on EOF */
+static ssize_t recvRequest(int sock, char *buf, size_t len, int fds[3]) {
+    char cbuf[CMSG_SPACE(sizeof(int) * 3)];
+    struct iovec iov = { .iov_base = buf, .iov_len = len };
+    struct msghdr msg = {
+        .msg_iov = &iov, .msg_iovlen = 1,
+        .msg_control = cbuf, .msg_controllen = sizeof(cbuf),
+    };
+
+    ssize_t n = recvmsg(sock, &msg, MSG_CMSG_CLOEXEC);
+    if (n <= 0)
+        return n;
+
+    struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg);
+    if (!cmsg || cmsg->cmsg_level != SOL_SOCKET || cmsg->cmsg_type != SCM_RIGHTS
+            || cmsg->cmsg_len != CMSG_LEN(sizeof(int) * 3)) {
+        fprintf(stderr, "Malformed request\n");
+        return -1;
+    }
+    memcpy(fds, CMSG_DATA(cmsg), sizeof(int) * 3);
+    return n;
+}
+
+static void report(int sock, pid_t pid, const char *key, const char *value) {
+    dprintf(sock, "[S][%d] __STAT__:0 %s = %s\n", pid, key, value);
+}
+
+static void reportLong(int sock, pid_t pid, const char *key, long value) {
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%ld", value);
+    report(sock, pid, key, buf);
+}
+
+static void runOnce(int sock, char *argv[], int fds[3], unsigned wall, unsigned cpu) {
+    struct timespec t0, t1;
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+
+    pid_t pid = fork();
+    if (pid < 0) {
+        perror("fork");
+        dprintf(sock, "\n");
+        return;
+    }
+    if (pid == 0) {
+        setpgid(0, 0);
+        signal(SIGPIPE, SIG_DFL);
+        signal(SIGALRM, SIG_DFL);
+        signal(SIGCHLD, SIG_DFL);
+        sigprocmask(SIG_SETMASK, &wait_mask, NULL);
+
+        int devnull = open("/dev/null", O_WRONLY | O_CLOEXEC);
+        if (dup2(fds[0], 0) < 0 || dup2(fds[1], 1) < 0 || devnull < 0 || dup2(devnull, 2) < 0)
+            _exit(127);
+        close(sock);
+
+        if (cpu > 0) {
+            struct rlimit rl = { cpu, cpu };
+            setrlimit(RLIMIT_CPU, &rl);
+        }
+        if (denyExtraSyscalls() != 0)
+            _exit(127);
+        execv(argv[0], argv);
+        _exit(127);
+    }
+
+    /* either of both may come first */
+    setpgid(pid, pid);
+    /* the program holds the only write end of its stdout from now on */
+    close(fds[0]);
+    close(fds[1]);
+
+    timed_out = 0;
+    if (wall > 0)
+        alarm(wall);
+
+    int status = 0, killed = 0;
+    struct rusage ru;
+    struct pollfd pfd = { .fd = fds[2], .events = POLLIN };
+    for (;;) {
+        pid_t r = wait4(pid, &status, WNOHANG, &ru);
+        if (r == pid)
+            break;
+        if (r < 0 && errno != EINTR) {
+            perror("wait4");
+            close(fds[2]);
+            dprintf(sock, "\n");
+            return;
+        }
+        if (!killed && (timed_out || pfd.revents)) {
+            kill(-pid, SIGKILL);
+            killed = 1;
+            pfd.fd = -1;
+        }
+        pfd.revents = 0;
+        /* returns as soon as a signal is caught or the judge writes */
+        ppoll(&pfd, 1, NULL, &wait_mask);
+    }
+    alarm(0);
+    close(fds[2]);
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+
+    /* whatever the program has left behind, which the runner reaps as the
+       subreaper; the group has no other way out */
+    kill(-pid, SIGKILL);
+    while (waitpid(-1, NULL, 0) > 0 || errno == EINTR)
+        ;
+
+    long elapsed = (t1.tv_sec - t0.tv_sec) * 1000 + (t1.tv_nsec - t0.tv_nsec) / 1000000;
+    int signaled = WIFSIGNALED(status);
+    int sig = signaled ? WTERMSIG(status) : 0;
+
+    reportLong(sock, pid, "time", elapsed);
+    reportLong(sock, pid, "cgroup_memory_max_usage", ru.ru_maxrss * 1024L);
+    /* killed by someone but us, which is the OOM killer of the cgroup; the
+       judge replaces it with the counter of the cgroup when it can read it */
+    reportLong(sock, pid, "cgroup_memory_failcnt", signaled && sig == SIGKILL && !killed);
+    report(sock, pid, "exit_normally", signaled ? "false" : "true");
+    report(sock, pid, "seccomp_violation", sig == SIGSYS ? "true" : "false");
+    reportLong(sock, pid, "exit_status", signaled ? 128 + sig : WEXITSTATUS(status));
+    dprintf(sock, "\n");
+}
+
+int main(int argc, char *argv[]) {
+    if (argc < 3) {
+        fprintf(stderr, "Usage: %s <socket fd> <program> [args...]\n", argv[0]);
+        return 1;
+    }
+    int sock = atoi(argv[1]);
+
+    signal(SIGPIPE, SIG_IGN);
+    /* orphans of the programs are reparented here, even if it is not PID 1 */
+    prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0);
+    struct sigaction sa;
+    memset(&sa, 0, sizeof(sa));
+    sa.sa_handler = onAlarm;
+    sigaction(SIGALRM, &sa, NULL);
+    sa.sa_handler = onChild;
+    sigaction(SIGCHLD, &sa, NULL);
+
+    /* both are only taken in ppoll(), so that none is missed */
+    sigset_t block;
+    sigemptyset(&block);
+    sigaddset(&block, SIGALRM);
+    sigaddset(&block, SIGCHLD);
+    sigprocmask(SIG_BLOCK, &block, &wait_mask);
+
+    for (;;) {
+        char buf[64];
+        int fds[3];
+        ssize_t n = recvRequest(sock, buf, sizeof(buf) - 1, fds);
+        if (n <= 0)
+            break;
+        buf[n] = '\0';
+
+        unsigned wall = 0, cpu = 0;
+        if (sscanf(buf, "%u %u", &wall, &cpu) < 1) {
+            fprintf(stderr, "Malformed request: %s\n", buf);
+            close(fds[0]);
+            close(fds[1]);
+            close(fds[2]);
+            dprintf(sock, "\n");
+            continue;
+        }
+        runOnce(sock, argv + 2, fds, wall, cpu);
+    }
+    return 0;
+}
@@ -0,0 +1,33 @@
+#!/bin/bash
+# Generate nsjail.forkserver.cfg: the policy of nsjail.cfg plus the syscalls
+# listed in runner/extra_syscalls.h, which the runner denies again to the
+# programs it runs
+
+pushd "$(dirname "${0}")/.." > /dev/null
+
+extra=$(sed -n 's/^X(\([a-z0-9_]*\))$/\1/p' runner/extra_syscalls.h)
+if [ -z "${extra}" ]; then
+    echo "No syscalls found in runner/extra_syscalls.h" >&2
+    exit 1
+fi
+# one quoted line per syscall, comma-separated
+lines=$(printf "  '  %s,'\\\\n" ${extra})
+lines=${lines%,\'\\n}\'
+
+{
+    echo "# generated from nsjail.cfg by scripts/gen-forkserver-cfg.sh; do not edit"
+    sed -e "s/^name: .*/name: 'nsjail profile for the HOJ fork server (runner\/runner.c)'/" \
+        -e "s/^\(  '  [a-z0-9_]*\)'$/\1,'/" \
+        -e "s/^  '} DEFAULT KILL'$/  # used by the runner only\n${lines}\n&/" \
+        nsjail.cfg
+} > nsjail.forkserver.cfg.tmp
+
+# fail rather than leave a policy without the extra syscalls
+if ! grep -q "^  '  ${extra##*[[:space:]]}'$" nsjail.forkserver.cfg.tmp; then
+    echo "Cannot find the end of the syscall list in nsjail.cfg" >&2
+    rm -f nsjail.forkserver.cfg.tmp
+    exit 1
+fi
+mv nsjail.forkserver.cfg.tmp nsjail.forkserver.cfg
+
+popd > /dev/null
@@ -35,16 +35,16 @@ def symlink_force(*args):
         else:
             raise e
 
-def main(cxt, checker_exec='./checker'):
-    logger.debug('Checker path={}'.format(checker_exec))
+def main(cxt, checker_exec='./checker', workdir='/run/shm'):
+    logger.debug('Checker path={}, workdir={}'.format(checker_exec, workdir))
 
     pathIn = cxt.subtask.input_path
     pathOut_user = cxt.subtask.output_user_path
     pathOut = cxt.subtask.output_path
 
-    pShmIn = '/run/shm/in.txt'
-    pShmOut = '/run/shm/out.txt'
-    pShmAns = '/run/shm/ans.txt'
+    pShmIn = path.join(workdir, 'in.txt')
+    pShmOut = path.join(workdir, 'out.txt')
+    pShmAns = path.join(workdir, 'ans.txt')
 
     for p, pShm in zip([pathIn, pathOut_user, pathOut],
                        [pShmIn, pShmOut, pShmAns]):
@@ -60,12 +60,12 @@ def main(cxt, checker_exec='./checker'):
     subp = None
     try:
         subp = subprocess.run([
-            './checker',
+            path.join(workdir, checker_exec),
             pShmIn,
             pShmOut,
             pShmAns,
             # 'special-report'
-        ], cwd='/run/shm')
+        ], cwd=workdir)
     except Exception as err:
         logger.error(err)
 
@@ -90,8 +90,8 @@ def main(cxt, checker_exec='./checker'):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
-        sys.stderr.write('Wrong number of arguments.\nUsage: {} [checker-path]\n'.format(sys.argv[0]))
+    if len(sys.argv) > 3:
+        sys.stderr.write('Wrong number of arguments.\nUsage: {} [checker-path [workdir]]\n'.format(sys.argv[0]))
         sys.exit(1)
 
     cxtInpBin = sys.stdin.buffer.read()
@@ -13,36 +13,18 @@ sys.path.append(path.join(cwd, '..'))
 from hoj_judge.protos import subtask_context_pb2
 from hoj_judge.protos import subtask_response_pb2
 from hoj_judge._hoj_helpers import *
+from hoj_judge.diff import tolerantDiffAt
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('__utils/tolerant_diff')
 
-def rstrip(s):
-    while s and (s[-1] == '\r' or s[-1] == '\n'):
-        s = s[:-1]
-    return s
-
-
-def tolerantDiffAt(fa, fb):
-    line = 0
-    while True:
-        la, lb = fa.readline(), fb.readline()
-        if la:
-            if not lb or rstrip(la.strip()) != rstrip(lb.strip()): return line
-        elif lb:
-            return line
-        else:
-            break
-        line += 1
-    return -1
-
 def main(cxt):
     pathOut = cxt.subtask.output_path
     pathOut_user = cxt.subtask.output_user_path
 
-    fOut_user = open(pathOut_user, 'r')
-    fOut = open(pathOut, 'r')
+    fOut_user = open(pathOut_user, 'rb')
+    fOut = open(pathOut, 'rb')
     diffResult = tolerantDiffAt(fOut_user, fOut)
     fOut_user.close()
     fOut.close()